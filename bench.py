@@ -0,0 +1,1017 @@
+import os
+import sys
+import time
+import resource
+import argparse
+import subprocess
+import tempfile
+import json
+import random
+import threading
+import statistics
+import socket
+import itertools
+import difflib
+import re
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import aiohttp
+import uvicorn
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("DOWNLOADS_DIR", tempfile.mkdtemp(prefix="asr_bench_"))
+
+import main
+
+class BurnEngine:
+    name = "burn"
+    rtf = 0.05
+    def load(self):
+        pass
+    def configured(self, language):
+        return True
+    def supports(self, language):
+        return True
+    def transcribe(self, pcm, language):
+        deadline = time.thread_time() + self.rtf * len(pcm) / (main.PCM_RATE * main.PCM_WIDTH)
+        n = 0
+        while time.thread_time() < deadline:
+            n += 1
+        return f"burn {n}"
+
+class StubEngine:
+    name = "stub"
+    def __init__(self, latency=0.5, rtf=0.02, fail_rate=0.0):
+        self.latency = latency
+        self.rtf = rtf
+        self.fail_rate = fail_rate
+    def load(self):
+        pass
+    def configured(self, language):
+        return True
+    def supports(self, language):
+        return True
+    def transcribe(self, pcm, language):
+        seconds = len(pcm) / (main.PCM_RATE * main.PCM_WIDTH)
+        time.sleep(self.latency + self.rtf * seconds)
+        if random.random() < self.fail_rate:
+            raise RuntimeError("stub failure")
+        return f"stub {len(pcm)} {random.random():.6f}"
+
+class CountingPopen(subprocess.Popen):
+    count = 0
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        super().__init__(*args, **kwargs)
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    def log_message(self, *args):
+        pass
+    def _reply(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+    p429 = 0.0
+    slow_rate = 0.0
+    slow_seconds = 0.0
+    file_delay = 0.0
+    file_bytes = 4096
+    file_source = None
+    file_rate = 0
+    calls = Counter()
+    def do_GET(self):
+        if "/file/bot" in self.path and self.file_source:
+            self.send_file()
+        elif "/file/bot" in self.path:
+            time.sleep(self.file_delay)
+            self._reply(200, b"\0" * self.file_bytes, "application/octet-stream")
+        else:
+            self.api()
+    def do_POST(self):
+        self._body()
+        self.api()
+    def api(self):
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        if ":generateContent" in self.path:
+            self.gemini()
+        elif method == "getFile":
+            self._reply(200, {"ok": True, "result": {"file_id": "f", "file_unique_id": "f", "file_path": "voice/file.oga"}})
+        elif method.startswith(("send", "edit")) and method != "sendChatAction":
+            self._reply(200, {"ok": True, "result": {"message_id": self.calls[method], "date": 0, "chat": {"id": 1, "type": "private"}}})
+        else:
+            self._reply(200, {"ok": True, "result": True})
+    def send_file(self):
+        size = os.path.getsize(self.file_source)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        block = 65536
+        with open(self.file_source, "rb") as f:
+            for data in iter(lambda: f.read(block), b""):
+                if self.file_rate:
+                    time.sleep(len(data) / self.file_rate)
+                self.wfile.write(data)
+    def gemini(self):
+        if random.random() < self.p429:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if random.random() < self.slow_rate:
+            time.sleep(self.slow_seconds)
+        self._reply(200, {"candidates": [{"content": {"parts": [{"text": "fake gemini reply"}]}}]})
+
+class FakeServer:
+    def __init__(self, handler=FakeHandler):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.handle_error = lambda request, client_address: None
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0, 0.0
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+def make_fixture(seconds, path=None, duty=1.0):
+    path = path or os.path.join(main.DOWNLOADS_DIR, f"fixture_{int(seconds)}s_{int(duty * 100)}.mp4")
+    if os.path.exists(path):
+        return path
+    if duty >= 1.0:
+        audio = f'sine=frequency=440:duration={seconds}'
+    else:
+        audio = f"aevalsrc='if(lt(mod(t\\,10)\\,{duty * 10})\\,0.3*sin(2*PI*440*t)\\,0)':s=16000:d={seconds}"
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', audio,
+        '-f', 'lavfi', '-i', f'color=c=black:s=64x64:r=5:d={seconds}',
+        '-shortest', '-c:a', 'aac', '-c:v', 'libx264', path
+    ]
+    subprocess.run(cmd, check=True)
+    return path
+
+def corpus_files(paths):
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(sorted(os.path.join(p, f) for f in os.listdir(p) if not f.startswith('.')))
+        else:
+            files.append(p)
+    return files
+
+def measure(fn, *args):
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    child_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.perf_counter()
+    out = fn(*args)
+    wall = time.perf_counter() - t0
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    child_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (self_after.ru_utime + self_after.ru_stime - self_before.ru_utime - self_before.ru_stime)
+    cpu += (child_after.ru_utime + child_after.ru_stime - child_before.ru_utime - child_before.ru_stime)
+    return out, wall, cpu
+
+def legacy_segments(file_path):
+    duration = main.get_audio_duration(file_path)
+    total = int((duration + main.CHUNK_SECONDS - 1) // main.CHUNK_SECONDS)
+    sizes = []
+    for i in range(total):
+        start = i * main.CHUNK_SECONDS
+        temp_chunk_file = os.path.join(main.DOWNLOADS_DIR, f"legacy_{i}.wav")
+        actual_start = max(0, start - main.CHUNK_OVERLAP)
+        actual_duration = main.CHUNK_SECONDS + (main.CHUNK_OVERLAP if start > 0 else 0)
+        cmd = [
+            'ffmpeg', '-y',
+            '-ss', str(actual_start),
+            '-t', str(actual_duration),
+            '-i', file_path,
+            '-f', 'lavfi', '-i', 'anullsrc=channel_layout=mono:sample_rate=16000',
+            '-filter_complex', f'[1:a]atrim=end={main.SILENCE_PADDING}[sil];[sil][0:a]concat=n=2:v=0:a=1[out]',
+            '-map', '[out]',
+            '-ar', '16000', '-ac', '1',
+            temp_chunk_file
+        ]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(temp_chunk_file, 'rb') as f:
+            sizes.append(len(f.read()))
+        os.remove(temp_chunk_file)
+    return sizes
+
+def single_pass_segments(file_path):
+    return [len(chunk) for _, _, chunk, _ in main.stream_pcm_chunks(file_path)]
+
+def buffered_segments(file_path):
+    cmd = ['ffmpeg', '-v', 'error', '-i', file_path, '-vn', '-ac', '1', '-ar', str(main.PCM_RATE), '-f', 's16le', '-']
+    pcm = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    step = int(main.CHUNK_SECONDS * main.PCM_RATE) * main.PCM_WIDTH
+    overlap = int(main.CHUNK_OVERLAP * main.PCM_RATE) * main.PCM_WIDTH
+    padding = bytes(main.SILENCE_PADDING * main.PCM_RATE * main.PCM_WIDTH)
+    chunks = [padding + pcm[max(0, start - overlap):start + step] for start in range(0, len(pcm), step)]
+    return [len(c) for c in chunks]
+
+def cmd_segment(args):
+    path = args.file or make_fixture(args.seconds)
+    print(f"file={path} chunk_seconds={main.CHUNK_SECONDS} overlap={main.CHUNK_OVERLAP}")
+    for name, fn in (("per-chunk", legacy_segments), ("single-pass", single_pass_segments)):
+        for _ in range(args.repeat):
+            sizes, wall, cpu = measure(fn, path)
+            print(f"{name:12s} chunks={len(sizes):3d} wall={wall:7.2f}s cpu={cpu:7.2f}s")
+
+def cmd_stream_one(args):
+    t0 = time.perf_counter()
+    first = None
+    sizes = []
+    if args.variant == "stream":
+        for _, _, chunk, _ in main.stream_pcm_chunks(args.file):
+            if first is None:
+                first = time.perf_counter() - t0
+            sizes.append(len(chunk))
+    else:
+        sizes = buffered_segments(args.file)
+        first = time.perf_counter() - t0
+    wall = time.perf_counter() - t0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{args.variant:9s} chunks={len(sizes):3d} first_chunk={first:6.2f}s wall={wall:6.2f}s peak_rss={rss:7.1f}MiB")
+
+def cmd_stream(args):
+    path = args.file or make_fixture(args.seconds)
+    print(f"file={path}")
+    for variant in ("buffered", "stream"):
+        subprocess.run([sys.executable, os.path.abspath(__file__), "stream-one", variant, path], check=True)
+
+def cmd_vad(args):
+    files = corpus_files(args.paths) or [make_fixture(args.seconds, duty=0.6)]
+    decoded = sent = 0.0
+    t0 = time.perf_counter()
+    for path in files:
+        stats = {}
+        chunks = sum(1 for _ in main.stream_pcm_chunks(path, stats=stats))
+        decoded += stats["decoded_seconds"]
+        sent += stats["sent_seconds"]
+        print(f"{os.path.basename(path):30s} chunks={chunks:3d} decoded={stats['decoded_seconds']:8.1f}s sent={stats['sent_seconds']:8.1f}s")
+    wall = time.perf_counter() - t0
+    saved = decoded - sent
+    pct = 100.0 * saved / decoded if decoded else 0.0
+    print(f"total decoded={decoded:.1f}s sent={sent:.1f}s recognizer-seconds saved={saved:.1f}s ({pct:.1f}%) wall={wall:.2f}s")
+
+def cmd_engines(args):
+    files = corpus_files(args.paths) or [make_fixture(args.seconds, duty=0.6)]
+    chunks = [chunk for path in files for _, _, chunk, _ in main.stream_pcm_chunks(path, chunk_seconds=args.chunk_seconds)]
+    audio = sum(len(c) for c in chunks) / (main.PCM_RATE * main.PCM_WIDTH)
+    for name in args.engines.split("|"):
+        engine = main.asr_router.engines[name]
+        try:
+            engine.load()
+        except Exception as e:
+            print(f"{name:8s} unavailable: {e}")
+            continue
+        if not engine.supports(args.language):
+            print(f"{name:8s} does not support {args.language}")
+            continue
+        t0 = time.perf_counter()
+        failures = 0
+        for chunk in chunks:
+            try:
+                engine.transcribe(chunk, args.language)
+            except Exception:
+                failures += 1
+        wall = time.perf_counter() - t0
+        print(f"{name:8s} audio={audio:8.1f}s wall={wall:8.2f}s rtf={wall / audio:6.3f} failures={failures}")
+
+def cmd_scaling(args):
+    chunk = bytes(int(args.chunk_seconds * main.PCM_RATE) * main.PCM_WIDTH)
+    audio = args.chunks * args.chunk_seconds
+    print(f"cores={len(os.sched_getaffinity(0))} chunks={args.chunks}x{args.chunk_seconds}s simulated_rtf={BurnEngine.rtf}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        for mode in ("threads", "processes"):
+            engine = main.ProcessEngine(BurnEngine, workers) if mode == "processes" else BurnEngine()
+            engine.load()
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda c: engine.transcribe(c, "en"), [chunk] * args.chunks))
+            wall = time.perf_counter() - t0
+            if mode == "processes":
+                engine.executor.shutdown()
+            print(f"{mode:9s} workers={workers:2d} wall={wall:6.2f}s throughput={audio / wall:8.1f} audio-s/s")
+
+def bench_engine(spec):
+    if spec.name == "stub":
+        return StubEngine(spec.latency, spec.rtf, spec.fail_rate)
+    if spec.name == "burn":
+        return BurnEngine()
+    if spec.name == "burn-proc":
+        return main.ProcessEngine(BurnEngine, spec.workers)
+    return main.asr_router.engines[spec.name]
+
+def cmd_e2e_one(args):
+    spec = argparse.Namespace(**json.loads(args.params))
+    main.ADAPTIVE_PLAN = not spec.chunk
+    main.CHUNK_SECONDS = spec.chunk or main.CHUNK_SECONDS
+    main.MAX_CONCURRENT_CHUNKS = spec.workers
+    main.CHUNK_OVERLAP = spec.overlap
+    main.SILENCE_PADDING = spec.padding
+    main.MAX_PENDING_CHUNKS = spec.workers * 2
+    main.job_scheduler = main.JobScheduler(spec.workers, max(main.MAX_ACTIVE_JOBS, spec.jobs))
+    engine = bench_engine(spec)
+    engine.load()
+    main.asr_router = main.EngineRouter([engine], engine.name, "")
+    main.asr_router.load()
+    server = FakeServer(type("TelegramHandler", (FakeHandler,), {"calls": Counter()}))
+    main.telebot.apihelper.API_URL = server.url + "/bot{0}/{1}"
+    subprocess.Popen = CountingPopen
+    files = [spec.files[i % len(spec.files)] for i in range(spec.jobs)]
+    audio = sum(main.get_audio_duration(f) for f in files)
+    CountingPopen.count = 0
+    def one(job):
+        i, path = job
+        stats = {}
+        main.transcribe_file(path, language=spec.language, chat_id=1000 + i, reply_id=1, stats=stats)
+        return stats.get("failed_chunks", 0)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=spec.jobs) as pool:
+        failed = sum(pool.map(one, enumerate(files)))
+    wall = time.perf_counter() - t0
+    server.close()
+    recognized = main.metrics.counters[("asr_recognized_audio_seconds_total", ())]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    workers = spec.workers if spec.name == "burn-proc" else 0
+    print(json.dumps({"audio": audio, "wall": wall, "recognized": recognized, "failed": failed, "rss": rss, "child_rss": child_rss, "subprocesses": CountingPopen.count + workers}))
+
+def cmd_e2e(args):
+    files = corpus_files(args.paths) or [make_fixture(s, duty=args.duty) for s in [float(x) for x in args.seconds.split(",")]]
+    grid = itertools.product(
+        [0.0 if x == "auto" else float(x) for x in args.chunk.split(",")],
+        [float(x) for x in args.overlap.split(",")],
+        [int(x) for x in args.padding.split(",")],
+        [int(x) for x in args.workers.split(",")],
+    )
+    print(f"engine={args.engine} files={len(files)} jobs={args.jobs} cores={len(os.sched_getaffinity(0))}")
+    for chunk, overlap, padding, workers in grid:
+        params = {
+            "chunk": chunk, "overlap": overlap, "padding": padding, "workers": workers,
+            "name": args.engine, "latency": args.latency, "rtf": args.rtf, "fail_rate": args.fail_rate,
+            "files": files, "jobs": args.jobs, "language": args.language,
+        }
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "e2e-one", json.dumps(params)], stdout=subprocess.PIPE, check=True).stdout
+        r = json.loads(out.decode().strip().splitlines()[-1])
+        print(f"chunk={chunk or 'auto':>5}s overlap={overlap:3.1f}s padding={padding}s workers={workers:2d} audio={r['audio']:8.1f}s wall={r['wall']:7.2f}s "
+              f"throughput={r['audio'] / r['wall']:7.1f}x rtf={r['wall'] / r['audio']:6.4f} recognized={r['recognized']:8.1f}s failed={r['failed']} "
+              f"peak_rss={r['rss']:6.1f}MiB ffmpeg_rss={r['child_rss']:6.1f}MiB subprocesses={r['subprocesses']}")
+
+def synthetic_chunks(rng, tokens, max_overlap, garble):
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(len(tokens), start + rng.randint(40, 120))
+        chunk = list(tokens[start:end])
+        if start and rng.random() < 0.5:
+            chunk = list(tokens[max(0, start - rng.randint(1, max_overlap)):start]) + chunk
+        if end < len(tokens) and rng.random() < garble:
+            chunk[-1] = chunk[-1][:max(1, len(chunk[-1]) // 2)]
+        chunks.append(" ".join(chunk))
+        start = end
+    return chunks
+
+def stitch_corpus(args):
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    rng = random.Random(args.seed)
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(3000)]
+    docs = []
+    for _ in range(args.docs):
+        tokens = [rng.choice(vocab) for _ in range(args.tokens)]
+        docs.append({"chunks": synthetic_chunks(rng, tokens, args.max_overlap, args.garble), "expected": " ".join(tokens)})
+    return docs
+
+def legacy_stitch(chunks):
+    seen = set()
+    full_text = ""
+    for text in chunks:
+        text = text.strip()
+        if text and text not in seen:
+            full_text += " " + text if full_text else text
+            seen.add(text)
+    return full_text
+
+def overlap_stitch(chunks):
+    stitcher = main.TranscriptStitcher()
+    for text in chunks:
+        stitcher.add(text)
+    return stitcher.text()
+
+def word_errors(expected, got):
+    ref, hyp = expected.split(), got.split()
+    errors = 0
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, ref, hyp, autojunk=False).get_opcodes():
+        if op != "equal":
+            errors += max(i2 - i1, j2 - j1)
+    return errors, len(ref)
+
+def cmd_stitch(args):
+    docs = stitch_corpus(args)
+    for name, fn in (("exact-match", legacy_stitch), ("overlap", overlap_stitch)):
+        errors = words = 0
+        for doc in docs:
+            e, n = word_errors(doc["expected"], fn(doc["chunks"]))
+            errors += e
+            words += n
+        print(f"{name:11s} docs={len(docs)} words={words} word_errors={errors} wer={100.0 * errors / max(1, words):6.3f}%")
+    rng = random.Random(args.seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    for tokens in (100000, 400000, 1600000):
+        chunks = synthetic_chunks(rng, [rng.choice(vocab) for _ in range(tokens)], args.max_overlap, 0.0)
+        for name, fn in (("exact-match", legacy_stitch), ("overlap", overlap_stitch)):
+            t0 = time.perf_counter()
+            fn(chunks)
+            wall = time.perf_counter() - t0
+            print(f"{name:11s} tokens={tokens:8d} chunks={len(chunks):6d} wall={wall:7.3f}s rate={tokens / wall / 1e6:6.2f}M tokens/s")
+
+def cmd_queue_worker(args):
+    engine = StubEngine(args.latency, args.rtf)
+    main.asr_router = main.EngineRouter([engine], engine.name, "")
+    for t in main.start_job_workers(args.threads):
+        t.join()
+
+def cmd_queue(args):
+    fixture = make_fixture(args.seconds, duty=0.7)
+    fake = FakeServer(type("TelegramHandler", (FakeHandler,), {"file_source": fixture, "calls": Counter()}))
+    main.telebot.apihelper.API_URL = fake.url + "/bot{0}/{1}"
+    shared = tempfile.mkdtemp(prefix="asr_queue_")
+    env = dict(os.environ, TELEGRAM_API_BASE=fake.url, JOB_DB=os.path.join(shared, "jobs.sqlite3"), STATE_DB=os.path.join(shared, "state.sqlite3"),
+               CACHE_DB=os.path.join(shared, "cache.sqlite3"), DOWNLOADS_DIR=shared, JOB_VISIBILITY=str(args.visibility), JOB_POLL_INTERVAL="0.2", JOB_RETRY_DELAY="0.5")
+    main.job_queue = main.JobQueue(env["JOB_DB"], args.visibility, main.JOB_MAX_ATTEMPTS)
+    t0 = time.perf_counter()
+    for i in range(args.jobs):
+        main.enqueue_media_job(1000 + i, i + 1, 1000 + i, f"{main.TG_FILE_PREFIX}file{i}", f"unique{i}", "en", args.seconds)
+    enqueue_wall = time.perf_counter() - t0
+    cmd = [sys.executable, os.path.abspath(__file__), "queue-worker", "--threads", str(args.threads), "--latency", str(args.latency), "--rtf", str(args.rtf)]
+    workers = [subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(args.workers)]
+    killed = False
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < args.timeout:
+        st = main.job_queue.stats()
+        if st.get("done", 0) + st.get("failed", 0) >= args.jobs:
+            break
+        if args.kill_after and not killed and time.perf_counter() - t0 >= args.kill_after:
+            held = main.job_queue.conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' AND owner LIKE ?", (f"%:{workers[0].pid}:%",)).fetchone()[0]
+            if held:
+                workers[0].kill()
+                killed = True
+        time.sleep(0.2)
+    wall = time.perf_counter() - t0
+    for w in workers:
+        w.kill()
+        w.wait()
+    st = main.job_queue.stats()
+    retried = main.job_queue.conn.execute("SELECT COUNT(*) FROM jobs WHERE attempts > 1").fetchone()[0]
+    print(f"jobs={args.jobs} workers={args.workers}x{args.threads} enqueue={enqueue_wall * 1000 / args.jobs:6.2f}ms/job wall={wall:7.2f}s "
+          f"throughput={st.get('done', 0) / wall:6.2f} jobs/s audio={st.get('done', 0) * args.seconds / wall:7.1f}x killed={killed} retried={retried} states={st}")
+    fake.close()
+
+def cmd_soak(args):
+    store = main.StateStore(os.path.join(main.DOWNLOADS_DIR, "soak.sqlite3"))
+    text = "lorem ipsum " * (args.text_bytes // 12)
+    t0 = time.perf_counter()
+    for i in range(1, args.events + 1):
+        chat = i % args.chats
+        store.set_pref("lang", chat, "en")
+        store.set_pref("mode", chat, "Split messages")
+        store.put_transcript(chat, i, text, i - 1)
+        store.get_transcript(chat, i - args.chats)
+        path = os.path.join(main.DOWNLOADS_DIR, f"soak_{chat}")
+        store.put_pending(chat, main.PendingFile(path, i, chat, f"u{i}"))
+        if i % 3:
+            store.pop_pending(chat)
+        if i % args.report == 0:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            st = store.stats()
+            print(f"events={i:8d} peak_rss={rss:7.1f}MiB transcripts={st['transcripts']:6d} prefs={st['prefs']:6d} pending={st['pending']:6d} rate={i / (time.perf_counter() - t0):8.0f}/s")
+    st = store.stats()
+    if st["transcripts"] > main.STATE_MAX_TRANSCRIPTS + 100:
+        print("FAIL: transcript table is not bounded")
+        return 1
+    print("OK: state stays bounded")
+
+def cmd_http(args):
+    server = FakeServer()
+    main.GEMINI_API_BASE = server.url
+    payload = {"contents": [{"parts": [{"text": "x" * 2000}]}]}
+    def unpooled():
+        url = f"{server.url}/v1beta/models/{main.GEMINI_MODEL}:generateContent?key=k"
+        r = requests.post(url, json=payload, timeout=30)
+        r.raise_for_status()
+        return r.json()
+    def pooled():
+        return main.gemini_api_call(f"models/{main.GEMINI_MODEL}:generateContent", payload, "k")
+    for name, fn in (("unpooled", unpooled), ("pooled", pooled)):
+        latencies = []
+        def one(_):
+            t = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        wall = time.perf_counter() - t0
+        p50, p99 = percentiles(latencies)
+        print(f"{name:9s} requests={args.requests} concurrency={args.concurrency} wall={wall:6.2f}s p50={p50 * 1000:7.2f}ms p99={p99 * 1000:7.2f}ms")
+    server.close()
+
+def cmd_gemini(args):
+    handler = type("GeminiHandler", (FakeHandler,), {"p429": args.p429, "slow_rate": args.slow_rate, "slow_seconds": args.slow_seconds})
+    server = FakeServer(handler)
+    main.GEMINI_API_BASE = server.url
+    main.KEY_COOLDOWNS = dict(main.KEY_COOLDOWNS, rate_limit=args.cooldown)
+    for hedge in (0.0, args.hedge_after):
+        main.GEMINI_HEDGE_AFTER = hedge
+        main.gemini_rotator = main.KeyRotator([f"key{i}" for i in range(args.keys)], args.rpm, 0)
+        latencies = []
+        failures = [0]
+        def one(_):
+            t = time.perf_counter()
+            try:
+                main.ask_gemini("hello " * 50, "Summarize")
+                latencies.append(time.perf_counter() - t)
+            except Exception:
+                failures[0] += 1
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        wall = time.perf_counter() - t0
+        p50, p99 = percentiles(latencies)
+        print(f"hedge_after={hedge:4.2f}s keys={args.keys} p429={args.p429} slow={args.slow_rate}@{args.slow_seconds}s ok={len(latencies)} failed={failures[0]} wall={wall:6.2f}s p50={p50 * 1000:8.1f}ms p99={p99 * 1000:8.1f}ms")
+    server.close()
+
+def synthetic_update(i):
+    return {"update_id": i, "message": {
+        "message_id": i, "date": 0,
+        "chat": {"id": 100000 + i, "type": "private"},
+        "from": {"id": 100000 + i, "is_bot": False, "first_name": "bench"},
+        "voice": {"file_id": f"v{i}", "file_unique_id": f"u{i}", "duration": 5, "file_size": 4096},
+    }}
+
+def load_updates(path, count):
+    if not path:
+        return [json.dumps(synthetic_update(i)).encode() for i in range(1, count + 1)]
+    with open(path, encoding="utf-8") as f:
+        updates = [line.strip().encode() for line in f if line.strip()]
+    return [updates[i % len(updates)] for i in range(count)]
+
+def start_asgi_server():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = uvicorn.Server(uvicorn.Config(main.asgi_app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    server.thread = threading.Thread(target=server.run, daemon=True)
+    server.thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+async def replay_updates(url, updates, concurrency):
+    latencies = []
+    statuses = Counter()
+    slots = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def one(body):
+            async with slots:
+                t = time.perf_counter()
+                try:
+                    async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as r:
+                        await r.read()
+                        statuses[r.status] += 1
+                except aiohttp.ClientError:
+                    statuses["error"] += 1
+                latencies.append(time.perf_counter() - t)
+        await asyncio.gather(*(one(b) for b in updates))
+    return latencies, statuses
+
+def cmd_pipeline(args):
+    base = args.file or make_fixture(args.seconds)
+    fixtures = [("as-is", base)]
+    if not args.file:
+        faststart = base.replace(".mp4", "_faststart.mp4")
+        if not os.path.exists(faststart):
+            subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', base, '-c', 'copy', '-movflags', '+faststart', faststart], check=True)
+        fixtures = [("moov-at-end", base), ("faststart", faststart)]
+    for label, path in fixtures:
+        handler = type("FileHandler", (FakeHandler,), {"file_source": path, "file_rate": args.mbps * 125000})
+        server = FakeServer(handler)
+        main.TELEGRAM_API_BASE = server.url
+        info = main.File.de_json({"file_id": "f", "file_unique_id": "u", "file_path": os.path.basename(path)})
+        dest = os.path.join(main.DOWNLOADS_DIR, "pipeline_download")
+        def sequential():
+            main.download_file_from_telegram(info, dest)
+            return main.stream_pcm_chunks(dest)
+        def streamed():
+            return main.stream_pcm_chunks(dest, feed=main.download_feed(info, dest))
+        for name, start in (("sequential", sequential), ("streamed", streamed)):
+            t0 = time.perf_counter()
+            first = None
+            chunks = 0
+            for _ in start():
+                if first is None:
+                    first = time.perf_counter() - t0
+                chunks += 1
+            wall = time.perf_counter() - t0
+            print(f"{label:11s} {name:10s} size={os.path.getsize(path) / 1e6:6.1f}MB link={args.mbps}Mbit/s chunks={chunks:3d} first_chunk={first or 0:6.2f}s total={wall:6.2f}s")
+            main._remove_file(dest)
+        server.close()
+
+def cmd_replay(args):
+    updates = load_updates(args.updates, args.count)
+    server = fake = None
+    url = args.url
+    handled = [0]
+    if not url:
+        attrs = {"file_delay": args.file_delay, "calls": Counter()}
+        if args.language:
+            attrs["file_source"] = make_fixture(args.seconds, duty=0.7)
+            engine = StubEngine(args.latency, args.rtf)
+            main.asr_router = main.EngineRouter([engine], engine.name, "")
+            for raw in updates:
+                message = json.loads(raw).get("message") or {}
+                if message.get("chat"):
+                    main.state_store.set_pref("lang", message["chat"]["id"], args.language)
+        fake = FakeServer(type("TelegramHandler", (FakeHandler,), attrs))
+        main.async_tg.base = main.TELEGRAM_API_BASE = main.GEMINI_API_BASE = fake.url
+        main.telebot.apihelper.API_URL = fake.url + "/bot{0}/{1}"
+        handle = main.handle_update_async
+        async def counted(raw):
+            try:
+                await handle(raw)
+            finally:
+                handled[0] += 1
+        main.handle_update_async = counted
+        server, base = start_asgi_server()
+        url = base + main.WEBHOOK_PATH
+    t0 = time.perf_counter()
+    latencies, statuses = asyncio.run(replay_updates(url, updates, args.concurrency))
+    accept_wall = time.perf_counter() - t0
+    if fake:
+        while handled[0] < statuses[200] and time.perf_counter() - t0 < args.drain_timeout:
+            time.sleep(0.05)
+    wall = time.perf_counter() - t0
+    p50, p99 = percentiles(latencies)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"updates={len(updates)} concurrency={args.concurrency} accepted={statuses[200]} busy={statuses[503]} errors={statuses['error']} handled={handled[0]} accept_wall={accept_wall:6.2f}s drained_wall={wall:6.2f}s p50={p50 * 1000:7.2f}ms p99={p99 * 1000:7.2f}ms peak_rss={rss:7.1f}MiB")
+    if fake:
+        calls = fake.httpd.RequestHandlerClass.calls
+        print("telegram calls: " + " ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+    if server:
+        server.should_exit = True
+        server.thread.join(timeout=10)
+    if fake:
+        fake.close()
+
+class FakeAssemblyAI(FakeHandler):
+    done_min = 5.0
+    done_max = 20.0
+    transcripts = {}
+    lock = threading.Lock()
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        now = time.time()
+        with self.lock:
+            if path == "/v2/transcript":
+                self.calls["list"] += 1
+                body = {"transcripts": [{"id": tid, "status": self.status(t, now)} for tid, t in self.transcripts.items()]}
+            else:
+                self.calls["status"] += 1
+                tid = path.rsplit("/", 1)[-1]
+                t = self.transcripts[tid]
+                body = {"id": tid, "status": self.status(t, now), "text": f"transcript {tid}"}
+        self._reply(200, body)
+    def do_POST(self):
+        data = self._body()
+        if self.path == "/v2/upload":
+            self.calls["upload"] += 1
+            self._reply(200, {"upload_url": f"https://cdn.invalid/{len(data)}"})
+            return
+        payload = json.loads(data)
+        self.calls["create"] += 1
+        with self.lock:
+            tid = f"t{len(self.transcripts)}"
+            self.transcripts[tid] = {"done": time.time() + random.uniform(self.done_min, self.done_max), "webhook": payload.get("webhook_url"), "notified": False}
+        self._reply(200, {"id": tid, "status": "queued"})
+    @staticmethod
+    def status(t, now):
+        return "completed" if t["done"] <= now else "processing"
+    @classmethod
+    def deliver_webhooks(cls):
+        session = requests.Session()
+        while True:
+            time.sleep(0.05)
+            now = time.time()
+            with cls.lock:
+                due = [(tid, t) for tid, t in cls.transcripts.items() if t["webhook"] and not t["notified"] and t["done"] <= now]
+                for _, t in due:
+                    t["notified"] = True
+            for tid, t in due:
+                session.post(t["webhook"], json={"transcript_id": tid, "status": "completed"})
+
+def legacy_assemblyai(key, audio):
+    base = f"{main.ASSEMBLYAI_API_BASE}/v2"
+    headers = {"authorization": key}
+    upload_url = main.http_session.post(f"{base}/upload", headers=headers, data=audio).json()["upload_url"]
+    tid = main.http_session.post(f"{base}/transcript", headers=headers, json={"audio_url": upload_url, "language_code": "en"}).json()["id"]
+    while True:
+        data = main.http_session.get(f"{base}/transcript/{tid}", headers=headers).json()
+        if data["status"] == "completed":
+            return data["text"]
+        time.sleep(1)
+
+def cmd_assemblyai(args):
+    handler = type("AssemblyAIHandler", (FakeAssemblyAI,), {"done_min": args.done_min, "done_max": args.done_max, "calls": Counter(), "transcripts": {}, "lock": threading.Lock()})
+    fake = FakeServer(handler)
+    main.ASSEMBLYAI_API_BASE = fake.url
+    threading.Thread(target=handler.deliver_webhooks, daemon=True).start()
+    server, base = start_asgi_server()
+    audio = b"\0" * 4096
+    for mode in ("legacy", "poller", "webhook"):
+        handler.calls.clear()
+        main.ASSEMBLYAI_WEBHOOK_URL = base + main.ASSEMBLYAI_WEBHOOK_PATH if mode == "webhook" else ""
+        main.assemblyai_tracker = main.AssemblyAITracker(args.poll_min, args.poll_max, main.ASSEMBLYAI_TIMEOUT)
+        engine = main.AssemblyAIEngine(["bench"])
+        baseline = threading.active_count()
+        peak = [0]
+        stop = threading.Event()
+        def sample():
+            while not stop.wait(0.05):
+                peak[0] = max(peak[0], threading.active_count() - baseline)
+        threading.Thread(target=sample, daemon=True).start()
+        lags = []
+        t0 = time.perf_counter()
+        if mode == "legacy":
+            def one(_):
+                legacy_assemblyai("bench", audio)
+                lags.append(time.time())
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                list(pool.map(one, range(args.jobs)))
+        else:
+            futures = [engine.submit(audio, "en") for _ in range(args.jobs)]
+            for f in futures:
+                f.add_done_callback(lambda _: lags.append(time.time()))
+            for f in futures:
+                f.result()
+        wall = time.perf_counter() - t0
+        stop.set()
+        with handler.lock:
+            done = sorted(t["done"] for t in list(handler.transcripts.values())[-args.jobs:])
+        delays = [max(0.0, a - b) for a, b in zip(sorted(lags), done)]
+        p50, p99 = percentiles(delays)
+        checks = handler.calls["status"] + handler.calls["list"]
+        print(f"{mode:8s} jobs={args.jobs} wall={wall:6.2f}s status_requests={checks:5d} (list={handler.calls['list']}) per_job={checks / args.jobs:5.1f} notify_lag_p50={p50:5.2f}s p99={p99:5.2f}s extra_threads={peak[0]}")
+    server.should_exit = True
+    server.thread.join(timeout=10)
+    fake.close()
+
+class FloodHandler(FakeHandler):
+    rate = 1.0
+    burst = 4
+    buckets = {}
+    documents = Counter()
+    lock = threading.Lock()
+    def do_POST(self):
+        body = self._body()
+        path, _, query = self.path.partition("?")
+        method = path.rsplit("/", 1)[-1]
+        match = re.search(r"(?:^|&)chat_id=(-?\d+)", query) or re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+        chat_id = int(match.group(1)) if match else 0
+        now = time.time()
+        with self.lock:
+            self.calls[method] += 1
+            tokens, stamp = self.buckets.get(chat_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens < 1:
+                self.calls["429"] += 1
+                self.buckets[chat_id] = (tokens, now)
+                retry = max(1, int((1 - tokens) / self.rate + 0.999))
+                self._reply(429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry}", "parameters": {"retry_after": retry}})
+                return
+            self.buckets[chat_id] = (tokens - 1, now)
+            if method == "sendDocument":
+                owners = set(re.findall(rb"owner(\d+)\b", body))
+                self.documents["ok" if owners == {str(chat_id).encode()} else "mixed"] += 1
+        self._reply(200, {"ok": True, "result": {"message_id": self.calls[method], "date": 0, "chat": {"id": chat_id, "type": "private"}}})
+
+def legacy_send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
+    mode = main.get_user_mode(uid)
+    if len(text) > main.MAX_MESSAGE_CHUNK:
+        if mode == "Split messages":
+            sent = None
+            for i in range(0, len(text), main.MAX_MESSAGE_CHUNK):
+                sent = main.bot.send_message(chat_id, text[i:i+main.MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
+            return sent
+        fname = os.path.join(main.DOWNLOADS_DIR, f"{action}.txt")
+        with open(fname, "w", encoding="utf-8") as f:
+            f.write(text)
+        sent = main.bot.send_document(chat_id, open(fname, 'rb'), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
+        os.remove(fname)
+        return sent
+    return main.bot.send_message(chat_id, text, reply_to_message_id=reply_id)
+
+def cmd_outbox(args):
+    handler = type("Flood", (FloodHandler,), {"calls": Counter(), "documents": Counter(), "buckets": {}, "lock": threading.Lock()})
+    fake = FakeServer(handler)
+    main.TELEGRAM_API_BASE = fake.url
+    main.telebot.apihelper.API_URL = fake.url + "/bot{0}/{1}"
+    chats = list(range(1, args.chats + 1))
+    for chat_id in chats:
+        main.state_store.set_pref("mode", chat_id, "Split messages" if chat_id % 2 else "Text File")
+    for name in ("legacy", "outbox"):
+        handler.calls.clear()
+        handler.documents.clear()
+        handler.buckets.clear()
+        main.outbox = main.TelegramOutbox(main.TG_OUTBOX_WORKERS, main.TG_CHAT_RATE, main.TG_CHAT_BURST, main.TG_GLOBAL_RATE)
+        latencies = []
+        failures = [0]
+        def job(chat_id):
+            t0 = time.perf_counter()
+            progress_id = 1
+            for step in range(args.edits):
+                text = f"Transcribing: {step * 100 // args.edits}%"
+                if name == "legacy":
+                    try:
+                        main.bot.edit_message_text(text, chat_id, progress_id)
+                    except Exception:
+                        pass
+                else:
+                    main.outbox.edit(chat_id, progress_id, text)
+                time.sleep(args.edit_interval)
+            text = " ".join(f"owner{chat_id} word{i}" for i in range(args.words))
+            try:
+                if name == "legacy":
+                    legacy_send_long_text(chat_id, text, 1, chat_id)
+                else:
+                    main.outbox.delete(chat_id, progress_id)
+                    main.send_long_text(chat_id, text, 1, chat_id)
+                latencies.append(time.perf_counter() - t0)
+            except Exception:
+                failures[0] += 1
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(chats)) as pool:
+            list(pool.map(job, chats))
+        wall = time.perf_counter() - t0
+        p50, p99 = percentiles(latencies)
+        c = handler.calls
+        print(f"{name:7s} chats={len(chats)} delivered={len(latencies)} failed={failures[0]} wall={wall:6.2f}s p50={p50:6.2f}s p99={p99:6.2f}s "
+              f"edits={c['editMessageText']} sends={c['sendMessage']} documents={c['sendDocument']} (mixed={handler.documents['mixed']}) http_429={c['429']}")
+    fake.close()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the transcription pipeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("segment", help="per-chunk ffmpeg vs single-pass decode")
+    p.add_argument("--file")
+    p.add_argument("--seconds", type=float, default=3600)
+    p.add_argument("--repeat", type=int, default=1)
+    p.set_defaults(func=cmd_segment)
+    p = sub.add_parser("stream", help="peak RSS and time-to-first-chunk, buffered vs streamed PCM")
+    p.add_argument("--file")
+    p.add_argument("--seconds", type=float, default=3600)
+    p.set_defaults(func=cmd_stream)
+    p = sub.add_parser("vad", help="recognizer-seconds saved by silence-aware chunking")
+    p.add_argument("paths", nargs="*")
+    p.add_argument("--seconds", type=float, default=1800)
+    p.set_defaults(func=cmd_vad)
+    p = sub.add_parser("engines", help="real-time factor of each ASR engine")
+    p.add_argument("paths", nargs="*")
+    p.add_argument("--engines", default="google|vosk|whisper")
+    p.add_argument("--language", default="en")
+    p.add_argument("--seconds", type=float, default=120)
+    p.add_argument("--chunk-seconds", type=float, default=30)
+    p.set_defaults(func=cmd_engines)
+    p = sub.add_parser("scaling", help="local recognition throughput vs worker count, threads vs processes")
+    p.add_argument("--workers", default="1,2,4")
+    p.add_argument("--chunks", type=int, default=16)
+    p.add_argument("--chunk-seconds", type=float, default=30)
+    p.set_defaults(func=cmd_scaling)
+    p = sub.add_parser("e2e", help="transcribe_file end to end over a parameter grid with simulated recognizers")
+    p.add_argument("paths", nargs="*")
+    p.add_argument("--seconds", default="300,1800")
+    p.add_argument("--duty", type=float, default=0.7)
+    p.add_argument("--engine", default="stub", help="stub, burn, burn-proc or a configured engine name")
+    p.add_argument("--language", default="en")
+    p.add_argument("--latency", type=float, default=0.5)
+    p.add_argument("--rtf", type=float, default=0.02)
+    p.add_argument("--fail-rate", type=float, default=0.0)
+    p.add_argument("--jobs", type=int, default=2)
+    p.add_argument("--chunk", default="auto,293", help="comma-separated chunk lengths; auto uses the adaptive planner")
+    p.add_argument("--overlap", default="1.0")
+    p.add_argument("--padding", default="0,5")
+    p.add_argument("--workers", default="3,6")
+    p.set_defaults(func=cmd_e2e)
+    p = sub.add_parser("stitch", help="accuracy and speed of chunk transcript stitching")
+    p.add_argument("--corpus", help="JSONL of {\"chunks\": [...], \"expected\": \"...\"}; synthetic if omitted")
+    p.add_argument("--docs", type=int, default=200)
+    p.add_argument("--tokens", type=int, default=2000)
+    p.add_argument("--max-overlap", type=int, default=4)
+    p.add_argument("--garble", type=float, default=0.3)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=cmd_stitch)
+    p = sub.add_parser("queue", help="ingress enqueue plus worker processes draining the durable job queue")
+    p.add_argument("--jobs", type=int, default=40)
+    p.add_argument("--workers", type=int, default=3)
+    p.add_argument("--threads", type=int, default=2)
+    p.add_argument("--seconds", type=float, default=120)
+    p.add_argument("--latency", type=float, default=0.5)
+    p.add_argument("--rtf", type=float, default=0.02)
+    p.add_argument("--visibility", type=float, default=5)
+    p.add_argument("--kill-after", type=float, default=3, help="SIGKILL one worker holding a job after this many seconds; 0 to disable")
+    p.add_argument("--timeout", type=float, default=300)
+    p.set_defaults(func=cmd_queue)
+    p = sub.add_parser("queue-worker")
+    p.add_argument("--threads", type=int, default=2)
+    p.add_argument("--latency", type=float, default=0.5)
+    p.add_argument("--rtf", type=float, default=0.02)
+    p.set_defaults(func=cmd_queue_worker)
+    p = sub.add_parser("soak", help="sustained state-store traffic; memory and row counts must stay flat")
+    p.add_argument("--events", type=int, default=200000)
+    p.add_argument("--chats", type=int, default=20000)
+    p.add_argument("--text-bytes", type=int, default=4000)
+    p.add_argument("--report", type=int, default=20000)
+    p.set_defaults(func=cmd_soak)
+    p = sub.add_parser("http", help="unpooled vs pooled HTTP latency against a local stand-in server")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=cmd_http)
+    p = sub.add_parser("gemini", help="key rotation under injected 429s and slow responses")
+    p.add_argument("--keys", type=int, default=6)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--rpm", type=int, default=0)
+    p.add_argument("--p429", type=float, default=0.03)
+    p.add_argument("--slow-rate", type=float, default=0.05)
+    p.add_argument("--slow-seconds", type=float, default=2.0)
+    p.add_argument("--hedge-after", type=float, default=0.3)
+    p.add_argument("--cooldown", type=float, default=1.0)
+    p.set_defaults(func=cmd_gemini)
+    p = sub.add_parser("pipeline", help="download-then-decode vs decoding while the download is in flight")
+    p.add_argument("--file")
+    p.add_argument("--seconds", type=float, default=1800)
+    p.add_argument("--mbps", type=float, default=40)
+    p.set_defaults(func=cmd_pipeline)
+    p = sub.add_parser("replay", help="replay Update JSON against the async webhook server")
+    p.add_argument("--updates", help="JSONL file of recorded Update payloads; synthetic voice updates if omitted")
+    p.add_argument("--url", help="webhook URL of a running server; starts one in-process if omitted")
+    p.add_argument("--count", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=500)
+    p.add_argument("--file-delay", type=float, default=1.0)
+    p.add_argument("--drain-timeout", type=float, default=120)
+    p.add_argument("--language", help="preset this language for every chat so media runs the full pipeline against a stub recognizer")
+    p.add_argument("--seconds", type=float, default=120)
+    p.add_argument("--latency", type=float, default=0.5)
+    p.add_argument("--rtf", type=float, default=0.02)
+    p.set_defaults(func=cmd_replay)
+    p = sub.add_parser("assemblyai", help="per-job polling loops vs shared poller vs webhooks against a fake AssemblyAI")
+    p.add_argument("--jobs", type=int, default=50)
+    p.add_argument("--done-min", type=float, default=5.0)
+    p.add_argument("--done-max", type=float, default=20.0)
+    p.add_argument("--poll-min", type=float, default=main.ASSEMBLYAI_POLL_MIN)
+    p.add_argument("--poll-max", type=float, default=main.ASSEMBLYAI_POLL_MAX)
+    p.set_defaults(func=cmd_assemblyai)
+    p = sub.add_parser("outbox", help="direct Telegram sends vs the per-chat outbound queue against a rate-limited fake")
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--edits", type=int, default=10)
+    p.add_argument("--edit-interval", type=float, default=0.8)
+    p.add_argument("--words", type=int, default=2500)
+    p.set_defaults(func=cmd_outbox)
+    p = sub.add_parser("e2e-one")
+    p.add_argument("params")
+    p.set_defaults(func=cmd_e2e_one)
+    p = sub.add_parser("stream-one")
+    p.add_argument("variant", choices=("buffered", "stream"))
+    p.add_argument("file")
+    p.set_defaults(func=cmd_stream_one)
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
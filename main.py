@@ -2,16 +2,34 @@ import os
 import threading
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 import logging
 import time
 import shutil
 import subprocess
+import sqlite3
+import hashlib
+import io
 from flask import Flask, request, abort
+import aiohttp
+from fastapi import FastAPI, Request, Response
+import uvicorn
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update, File
 import speech_recognition as sr
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, shared_memory
+import functools
+from collections import OrderedDict, deque, Counter
 import random
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import re
+import numpy as np
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 WEBHOOK_URL_BASE = os.environ.get("WEBHOOK_URL_BASE", "")
@@ -27,12 +45,99 @@ DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
 GEMINI_KEY = os.environ.get("GEMINI_KEY", "")
 GEMINI_KEYS = os.environ.get("GEMINI_KEYS", GEMINI_KEY)
 GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip('/')
+GEMINI_TIMEOUT = int(os.environ.get("GEMINI_TIMEOUT", str(REQUEST_TIMEOUT)))
+GEMINI_CHUNK_CHARS = int(os.environ.get("GEMINI_CHUNK_CHARS", "12000"))
+GEMINI_PARALLEL = int(os.environ.get("GEMINI_PARALLEL", "4"))
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.environ.get("GEMINI_TPM", "250000"))
+GEMINI_HEDGE_AFTER = float(os.environ.get("GEMINI_HEDGE_AFTER", "0"))
+GEMINI_MAX_WAIT = float(os.environ.get("GEMINI_MAX_WAIT", "20"))
+KEY_COOLDOWNS = {"rate_limit": 60, "auth": 3600, "server": 10, "network": 5, "other": 5}
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip('/')
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+ASSEMBLYAI_KEYS = os.environ.get("ASSEMBLYAI_KEYS", "")
+ASSEMBLYAI_API_BASE = os.environ.get("ASSEMBLYAI_API_BASE", "https://api.assemblyai.com").rstrip('/')
+ASSEMBLYAI_WEBHOOK_PATH = os.environ.get("ASSEMBLYAI_WEBHOOK_PATH", "/assemblyai/")
+ASSEMBLYAI_WEBHOOK = os.environ.get("ASSEMBLYAI_WEBHOOK", "0") == "1"
+ASSEMBLYAI_WEBHOOK_SECRET = os.environ.get("ASSEMBLYAI_WEBHOOK_SECRET", "")
+ASSEMBLYAI_POLL_MIN = float(os.environ.get("ASSEMBLYAI_POLL_MIN", "2"))
+ASSEMBLYAI_POLL_MAX = float(os.environ.get("ASSEMBLYAI_POLL_MAX", "10"))
+ASSEMBLYAI_POLL_BATCH = 200
+ASSEMBLYAI_TIMEOUT = int(os.environ.get("ASSEMBLYAI_TIMEOUT", "3600"))
 ADMIN_ID = 6964068910
 
 MAX_WORKERS = 3
 CHUNK_SECONDS = 293
 CHUNK_OVERLAP = 1.0
 SILENCE_PADDING = 5
+PCM_RATE = 16000
+PCM_WIDTH = 2
+MAX_PENDING_CHUNKS = MAX_WORKERS * 2
+ADAPTIVE_PLAN = os.environ.get("ADAPTIVE_PLAN", "1") == "1"
+PLAN_FAST_SECONDS = float(os.environ.get("PLAN_FAST_SECONDS", "60"))
+PLAN_MIN_CHUNK = float(os.environ.get("PLAN_MIN_CHUNK", "30"))
+PLAN_MIN_CALL_SECONDS = float(os.environ.get("PLAN_MIN_CALL_SECONDS", "2"))
+PLAN_CHUNKS_PER_WORKER = 2
+STITCH_WINDOW = 24
+STITCH_MIN_TOKENS = 2
+STITCH_SLACK = 2
+STATE_DB = os.environ.get("STATE_DB", os.path.join(DOWNLOADS_DIR, "state.sqlite3"))
+STATE_MAX_TRANSCRIPTS = int(os.environ.get("STATE_MAX_TRANSCRIPTS", "5000"))
+STATE_TRANSCRIPT_TTL = int(os.environ.get("STATE_TRANSCRIPT_TTL", str(7 * 24 * 3600)))
+STATE_PREF_TTL = int(os.environ.get("STATE_PREF_TTL", str(180 * 24 * 3600)))
+PENDING_TTL = int(os.environ.get("PENDING_TTL", "3600"))
+CACHE_DB = os.environ.get("CACHE_DB", os.path.join(DOWNLOADS_DIR, "cache.sqlite3"))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(30 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_MB", "64")) * 1024 * 1024
+CHUNK_RETRIES = int(os.environ.get("CHUNK_RETRIES", "3"))
+CHUNK_RETRY_DELAY = 1.0
+ASR_ENGINES = os.environ.get("ASR_ENGINES", "google")
+ASR_LANG_ENGINES = os.environ.get("ASR_LANG_ENGINES", "")
+ENGINE_POOL_SIZE = int(os.environ.get("ENGINE_POOL_SIZE", "2"))
+ENGINE_SLOW_RTF = float(os.environ.get("ENGINE_SLOW_RTF", "1.0"))
+ENGINE_COOLDOWN = int(os.environ.get("ENGINE_COOLDOWN", "60"))
+LOCAL_ASR_PROCESSES = os.environ.get("LOCAL_ASR_PROCESSES", "0")
+VOSK_MODELS = os.environ.get("VOSK_MODELS", "")
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "tiny")
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "cpu")
+WHISPER_COMPUTE = os.environ.get("WHISPER_COMPUTE", "int8")
+STREAM_RESULTS = os.environ.get("STREAM_RESULTS", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "3"))
+PROGRESS_INTERVAL = 2.0
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+VAD_FRAME = 480
+VAD_THRESHOLD = float(os.environ.get("VAD_THRESHOLD", "300"))
+VAD_MIN_RMS = 30.0
+VAD_MIN_PAUSE = 0.3
+VAD_KEEP_SILENCE = 0.5
+VAD_SEARCH_SECONDS = 30
+VAD_BLOCK_SECONDS = 10
+MAX_CONCURRENT_CHUNKS = int(os.environ.get("MAX_CONCURRENT_CHUNKS", "6"))
+MAX_ACTIVE_JOBS = int(os.environ.get("MAX_ACTIVE_JOBS", "20"))
+MAX_UPDATE_WORKERS = int(os.environ.get("MAX_UPDATE_WORKERS", "32"))
+ASYNC_SERVER = os.environ.get("ASYNC_SERVER", "0") == "1"
+ASYNC_UPDATE_WORKERS = int(os.environ.get("ASYNC_UPDATE_WORKERS", "1000"))
+MAX_UPDATE_BACKLOG = int(os.environ.get("MAX_UPDATE_BACKLOG", "200"))
+BOT_ROLE = os.environ.get("BOT_ROLE", "all")
+JOB_DB = os.environ.get("JOB_DB", os.path.join(DOWNLOADS_DIR, "jobs.sqlite3"))
+JOB_VISIBILITY = float(os.environ.get("JOB_VISIBILITY", "300"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "10"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_TTL = int(os.environ.get("JOB_TTL", str(24 * 3600)))
+TG_FILE_PREFIX = "tg:"
+TG_OUTBOX_WORKERS = int(os.environ.get("TG_OUTBOX_WORKERS", "8"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", "3"))
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "5"))
+TG_OUTBOX_MAX_CHATS = 10000
+ASSEMBLYAI_WEBHOOK_URL = WEBHOOK_URL_BASE.rstrip('/') + ASSEMBLYAI_WEBHOOK_PATH if ASSEMBLYAI_WEBHOOK and WEBHOOK_URL_BASE and BOT_ROLE == "all" else ""
 
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -52,15 +157,393 @@ LANGS = [
 ("🇺🇿 O'zbekcha","uz"), ("🇵🇭 Tagalog","tl"), ("🇵🇹 Português","pt")
 ]
 
-user_mode = {}
-user_transcriptions = {}
-action_usage = {}
-user_selected_lang = {}
-pending_files = {}
+class PendingFile:
+    __slots__ = ("path", "message_id", "user_id", "file_id", "created")
+    def __init__(self, path, message_id, user_id, file_id, created=None):
+        self.path = path
+        self.message_id = message_id
+        self.user_id = user_id
+        self.file_id = file_id
+        self.created = created or time.time()
+
+class SQLiteStore:
+    schema = ()
+    def __init__(self, path, **connect_args):
+        self.path = path
+        self.connect_args = connect_args
+        self._conn = None
+        self._open_lock = threading.Lock()
+    @property
+    def conn(self):
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    conn = sqlite3.connect(self.path, check_same_thread=False, **self.connect_args)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    for statement in self.schema:
+                        conn.execute(statement)
+                    conn.commit()
+                    self._conn = conn
+        return self._conn
+
+class StateStore(SQLiteStore):
+    schema = (
+        "CREATE TABLE IF NOT EXISTS prefs (kind TEXT NOT NULL, owner INTEGER NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (kind, owner))",
+        "CREATE TABLE IF NOT EXISTS transcripts (chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, origin INTEGER NOT NULL, text TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (chat_id, message_id))",
+        "CREATE INDEX IF NOT EXISTS transcripts_created ON transcripts (created)",
+        "CREATE TABLE IF NOT EXISTS pending (chat_id INTEGER PRIMARY KEY, path TEXT NOT NULL, message_id INTEGER NOT NULL, user_id INTEGER NOT NULL, file_id TEXT, created REAL NOT NULL)",
+    )
+    def __init__(self, path):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.writes = 0
+    def get_pref(self, kind, owner, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM prefs WHERE kind = ? AND owner = ?", (kind, owner)).fetchone()
+        return row[0] if row else default
+    def set_pref(self, kind, owner, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO prefs (kind, owner, value, updated) VALUES (?, ?, ?, ?)", (kind, owner, value, time.time()))
+            self._wrote()
+    def put_transcript(self, chat_id, message_id, text, origin):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO transcripts (chat_id, message_id, origin, text, created) VALUES (?, ?, ?, ?, ?)", (chat_id, message_id, origin, text, time.time()))
+            self._wrote()
+    def get_transcript(self, chat_id, message_id):
+        with self.lock:
+            row = self.conn.execute("SELECT text, origin, created FROM transcripts WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)).fetchone()
+        if not row or time.time() - row[2] > STATE_TRANSCRIPT_TTL:
+            return None
+        return {"text": row[0], "origin": row[1]}
+    def put_pending(self, chat_id, pending):
+        old = self.pop_pending(chat_id)
+        if old:
+            _remove_file(old.path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO pending (chat_id, path, message_id, user_id, file_id, created) VALUES (?, ?, ?, ?, ?, ?)", (chat_id, pending.path, pending.message_id, pending.user_id, pending.file_id, pending.created))
+            self._wrote()
+    def pop_pending(self, chat_id):
+        with self.lock:
+            row = self.conn.execute("SELECT path, message_id, user_id, file_id, created FROM pending WHERE chat_id = ?", (chat_id,)).fetchone()
+            if not row:
+                return None
+            self.conn.execute("DELETE FROM pending WHERE chat_id = ?", (chat_id,))
+            self.conn.commit()
+        return PendingFile(*row)
+    def _wrote(self):
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self._evict()
+        self.conn.commit()
+    def _evict(self):
+        now = time.time()
+        self.conn.execute("DELETE FROM prefs WHERE updated < ?", (now - STATE_PREF_TTL,))
+        self.conn.execute("DELETE FROM transcripts WHERE created < ?", (now - STATE_TRANSCRIPT_TTL,))
+        self.conn.execute("DELETE FROM transcripts WHERE rowid IN (SELECT rowid FROM transcripts ORDER BY created DESC LIMIT -1 OFFSET ?)", (STATE_MAX_TRANSCRIPTS,))
+        for (path,) in self.conn.execute("SELECT path FROM pending WHERE created < ?", (now - PENDING_TTL,)).fetchall():
+            _remove_file(path)
+        self.conn.execute("DELETE FROM pending WHERE created < ?", (now - PENDING_TTL,))
+    def stats(self):
+        with self.lock:
+            return {t: self.conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("prefs", "transcripts", "pending")}
+
+def _remove_file(path):
+    try:
+        if path and os.path.exists(path):
+            os.remove(path)
+    except:
+        pass
+
+state_store = StateStore(STATE_DB)
+
+class JobQueue(SQLiteStore):
+    schema = (
+        "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, visible_at REAL NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, error TEXT)",
+        "CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, visible_at)",
+    )
+    def __init__(self, path, visibility, max_attempts):
+        super().__init__(path, isolation_level=None, timeout=30)
+        self.visibility = visibility
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.acks = 0
+    def put(self, kind, payload, delay=0):
+        now = time.time()
+        with self.lock:
+            return self.conn.execute("INSERT INTO jobs (kind, payload, state, visible_at, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)", (kind, json.dumps(payload), now + delay, now, now)).lastrowid
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute("SELECT id, payload FROM jobs WHERE state = 'running' AND visible_at <= ? AND attempts >= ?", (now, self.max_attempts)).fetchall()
+                self.conn.executemany("UPDATE jobs SET state = 'failed', error = 'visibility timeout', updated = ? WHERE id = ?", [(now, r[0]) for r in rows])
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        return [{"id": r[0], "payload": json.loads(r[1])} for r in rows]
+    def claim(self, owner):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT id, kind, payload, attempts FROM jobs WHERE state IN ('queued', 'running') AND visible_at <= ? ORDER BY id LIMIT 1", (now,)).fetchone()
+                if row:
+                    self.conn.execute("UPDATE jobs SET state = 'running', owner = ?, attempts = attempts + 1, visible_at = ?, updated = ? WHERE id = ?", (owner, now + self.visibility, now, row[0]))
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {"id": row[0], "kind": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1}
+    def touch(self, job_id, owner):
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute("UPDATE jobs SET visible_at = ?, updated = ? WHERE id = ? AND owner = ? AND state = 'running'", (now + self.visibility, now, job_id, owner))
+        return cur.rowcount > 0
+    def ack(self, job_id, owner):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET state = 'done', error = NULL, updated = ? WHERE id = ? AND owner = ?", (now, job_id, owner))
+            self.acks += 1
+            if self.acks % 100 == 0:
+                self.conn.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated < ?", (now - JOB_TTL,))
+    def fail(self, job_id, owner, error, retry_delay=JOB_RETRY_DELAY):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ? AND owner = ?", (job_id, owner)).fetchone()
+            if not row:
+                return False
+            final = row[0] >= self.max_attempts
+            if final:
+                self.conn.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? WHERE id = ?", (str(error), now, job_id))
+            else:
+                self.conn.execute("UPDATE jobs SET state = 'queued', error = ?, visible_at = ?, updated = ? WHERE id = ?", (str(error), now + retry_delay * 2 ** (row[0] - 1), now, job_id))
+        return final
+    def depth(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')").fetchone()[0]
+    def stats(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+job_queue = JobQueue(JOB_DB, JOB_VISIBILITY, JOB_MAX_ATTEMPTS)
+
+def _metric_labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timings = {}
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+    def observe(self, stage, seconds, **labels):
+        key = tuple(sorted(dict(labels, stage=stage).items()))
+        with self.lock:
+            h = self.timings.get(key)
+            if h is None:
+                h = self.timings[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[0][i] += 1
+            h[1] += 1
+            h[2] += seconds
+    @contextmanager
+    def timed(self, stage, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0, **labels)
+    def render(self):
+        lines = ["# TYPE asr_stage_seconds histogram"]
+        with self.lock:
+            for key, (counts, count, total) in sorted(self.timings.items()):
+                labels = _metric_labels(key)
+                for bound, n in zip(self.buckets, counts):
+                    lines.append(f'asr_stage_seconds_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'asr_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"asr_stage_seconds_count{{{labels}}} {count}")
+                lines.append(f"asr_stage_seconds_sum{{{labels}}} {total:.6f}")
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{{{_metric_labels(labels)}}} {value}" if labels else f"{name} {value}")
+        return lines
+
+metrics = Metrics(METRIC_BUCKETS)
+
+HTTP_TIMEOUTS = {
+    urlsplit(GEMINI_API_BASE).hostname: (HTTP_CONNECT_TIMEOUT, GEMINI_TIMEOUT),
+    urlsplit(TELEGRAM_API_BASE).hostname: (HTTP_CONNECT_TIMEOUT, REQUEST_TIMEOUT),
+    urlsplit(ASSEMBLYAI_API_BASE).hostname: (HTTP_CONNECT_TIMEOUT, REQUEST_TIMEOUT),
+}
+
+def build_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=1)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def http_timeout(url):
+    return HTTP_TIMEOUTS.get(urlsplit(url).hostname, (HTTP_CONNECT_TIMEOUT, REQUEST_TIMEOUT))
+
+TELEGRAM_API_HOST = urlsplit(TELEGRAM_API_BASE).hostname
+
+def _time_telegram_call(resp, *args, **kwargs):
+    url = urlsplit(resp.url)
+    if url.hostname == TELEGRAM_API_HOST and "/file/bot" not in url.path:
+        metrics.observe("telegram", resp.elapsed.total_seconds(), method=url.path.rsplit("/", 1)[-1])
+
+http_session = build_http_session()
+http_session.hooks["response"].append(_time_telegram_call)
+telebot.apihelper.session = http_session
+if TELEGRAM_API_BASE != "https://api.telegram.org":
+    telebot.apihelper.API_URL = TELEGRAM_API_BASE + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_BASE + "/file/bot{0}/{1}"
 
 bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
 flask_app = Flask(__name__)
 
+def telegram_retry_after(exc):
+    if isinstance(exc, telebot.apihelper.ApiTelegramException) and exc.error_code == 429:
+        return float((exc.result_json.get("parameters") or {}).get("retry_after") or 1)
+    return None
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.until = 0.0
+    def wait_time(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return max(self.until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+    def take(self):
+        self.tokens -= 1
+
+class TelegramOutbox:
+    def __init__(self, workers, chat_rate, chat_burst, global_rate):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.chats = OrderedDict()
+        self.buckets = {}
+        self.busy = set()
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.workers = workers
+        self.threads = []
+    def _start(self):
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+    def submit(self, chat_id, fn, *args, **kwargs):
+        return self._put(chat_id, {"fn": fn, "args": args, "kwargs": kwargs, "edit": None})
+    def call(self, chat_id, fn, *args, **kwargs):
+        return self.submit(chat_id, fn, *args, **kwargs).result()
+    def edit(self, chat_id, message_id, text, **kwargs):
+        with self.cond:
+            for op in self.chats.get(chat_id, ()):
+                if op["edit"] == message_id:
+                    op["args"] = (text, chat_id, message_id)
+                    op["kwargs"] = kwargs
+                    metrics.inc("telegram_coalesced_edits_total")
+                    return op["future"]
+        return self._put(chat_id, {"fn": bot.edit_message_text, "args": (text, chat_id, message_id), "kwargs": kwargs, "edit": message_id})
+    def delete(self, chat_id, message_id):
+        with self.cond:
+            q = self.chats.get(chat_id)
+            for op in [op for op in q or () if op["edit"] == message_id]:
+                q.remove(op)
+                self.pending -= 1
+                op["future"].set_result(None)
+                metrics.inc("telegram_coalesced_edits_total")
+            return self._put(chat_id, {"fn": bot.delete_message, "args": (chat_id, message_id), "kwargs": {}, "edit": None})
+    def depth(self):
+        with self.cond:
+            return self.pending
+    def _put(self, chat_id, op):
+        op["future"] = Future()
+        op["attempts"] = 0
+        with self.cond:
+            self._start()
+            if len(self.buckets) > TG_OUTBOX_MAX_CHATS:
+                self._prune(time.time())
+            self.chats.setdefault(chat_id, deque()).append(op)
+            self.pending += 1
+            self.cond.notify()
+        return op["future"]
+    def _prune(self, now):
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.chats and chat_id not in self.busy and bucket.wait_time(now) <= 0 and bucket.tokens >= bucket.burst:
+                del self.buckets[chat_id]
+    def _next(self):
+        while True:
+            now = time.time()
+            wait = self.bucket.wait_time(now)
+            if wait <= 0:
+                for chat_id in [c for c, q in self.chats.items() if not q]:
+                    del self.chats[chat_id]
+                for chat_id in self.chats:
+                    if chat_id in self.busy:
+                        continue
+                    bucket = self.buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+                    chat_wait = bucket.wait_time(now)
+                    if chat_wait > 0:
+                        wait = chat_wait if wait <= 0 else min(wait, chat_wait)
+                        continue
+                    q = self.chats[chat_id]
+                    op = q.popleft()
+                    if q:
+                        self.chats.move_to_end(chat_id)
+                    else:
+                        del self.chats[chat_id]
+                    self.pending -= 1
+                    self.busy.add(chat_id)
+                    bucket.take()
+                    self.bucket.take()
+                    return chat_id, op
+            self.cond.wait(wait if wait > 0 else None)
+    def _worker(self):
+        while True:
+            with self.cond:
+                chat_id, op = self._next()
+            retry = None
+            try:
+                op["future"].set_result(op["fn"](*op["args"], **op["kwargs"]))
+            except Exception as e:
+                retry = telegram_retry_after(e)
+                op["attempts"] += 1
+                if retry is None or op["attempts"] > TG_MAX_RETRIES:
+                    op["future"].set_exception(e)
+                    retry = None
+                else:
+                    logging.warning("Telegram flood control in chat %s, retrying in %ss", chat_id, retry)
+                    metrics.inc("telegram_retries_total")
+            with self.cond:
+                self.busy.discard(chat_id)
+                if retry is not None:
+                    self.buckets[chat_id].until = time.time() + retry
+                    self.chats.setdefault(chat_id, deque()).appendleft(op)
+                    self.pending += 1
+                self.cond.notify_all()
+
+outbox = TelegramOutbox(TG_OUTBOX_WORKERS, TG_CHAT_RATE, TG_CHAT_BURST, TG_GLOBAL_RATE)
+
 def notify_admin(message, file_type):
     try:
         bot.forward_message(ADMIN_ID, message.chat.id, message.message_id)
@@ -68,54 +551,160 @@ def notify_admin(message, file_type):
         pass
 
 def get_user_mode(uid):
-    return user_mode.get(uid, "Split messages")
+    return state_store.get_pref("mode", uid, "Split messages")
 
 def gemini_api_call(endpoint, payload, key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/{endpoint}?key={key}"
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?key={key}"
     headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+    resp = http_session.post(url, headers=headers, json=payload, timeout=http_timeout(url))
     resp.raise_for_status()
     return resp.json()
 
+def classify_gemini_error(exc):
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        if status == 429:
+            return "rate_limit"
+        if status in (401, 403):
+            return "auth"
+        if status >= 500:
+            return "server"
+        return "other"
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return "network"
+    return "other"
+
+def _retry_after(exc):
+    try:
+        return float(exc.response.headers.get("Retry-After"))
+    except Exception:
+        return None
+
 class KeyRotator:
-    def __init__(self, keys):
+    def __init__(self, keys, rpm=0, tpm=0):
         self.keys = [k.strip() for k in keys.split(",") if k.strip()] if isinstance(keys, str) else list(keys or [])
         self.pos = 0
+        self.rpm = rpm
+        self.tpm = tpm
         self.lock = threading.Lock()
-    def get_key(self):
+        self.health = {k: {"until": 0.0, "failures": 0, "window": deque(), "last_error": None, "ok": 0, "errors": 0} for k in self.keys}
+        self.labels = {k: f"{i}:{k[-4:]}" for i, k in enumerate(self.keys)}
+    def _available(self, key, now, tokens):
+        h = self.health[key]
+        if h["until"] > now:
+            return False
+        window = h["window"]
+        while window and window[0][0] <= now - 60:
+            window.popleft()
+        if self.rpm and len(window) >= self.rpm:
+            return False
+        if self.tpm and sum(t for _, t in window) + tokens > self.tpm:
+            return False
+        return True
+    def get_key(self, tokens=0, exclude=()):
+        with self.lock:
+            now = time.time()
+            for offset in range(len(self.keys)):
+                key = self.keys[(self.pos + offset) % len(self.keys)]
+                if key in exclude or not self._available(key, now, tokens):
+                    continue
+                self.pos = (self.keys.index(key) + 1) % len(self.keys)
+                self.health[key]["window"].append((now, tokens))
+                return key
+            return None
+    def next_ready(self):
         with self.lock:
             if not self.keys:
                 return None
-            key = self.keys[self.pos]
-            self.pos = (self.pos + 1) % len(self.keys)
-            return key
+            now = time.time()
+            waits = []
+            for h in self.health.values():
+                wait = max(0.0, h["until"] - now)
+                if self.rpm and len(h["window"]) >= self.rpm:
+                    wait = max(wait, h["window"][0][0] + 60 - now)
+                waits.append(wait)
+            return min(waits)
     def mark_success(self, key):
         with self.lock:
-            try:
-                i = self.keys.index(key)
-                self.pos = (i + 1) % len(self.keys)
-            except ValueError:
-                pass
-    def mark_failure(self, key):
-        self.mark_success(key)
+            if key in self.health:
+                h = self.health[key]
+                h["failures"] = 0
+                h["until"] = 0.0
+                h["ok"] += 1
+    def mark_failure(self, key, error=None):
+        kind = classify_gemini_error(error)
+        with self.lock:
+            if key not in self.health:
+                return
+            h = self.health[key]
+            h["failures"] += 1
+            h["errors"] += 1
+            h["last_error"] = kind
+            cooldown = KEY_COOLDOWNS[kind] * min(8, 2 ** (h["failures"] - 1))
+            if kind == "rate_limit":
+                cooldown = max(cooldown, _retry_after(error) or 0)
+            h["until"] = time.time() + cooldown
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {self.labels[k]: {"cooling": max(0.0, h["until"] - now), "ok": h["ok"], "errors": h["errors"], "last_error": h["last_error"]} for k, h in self.health.items()}
 
-gemini_rotator = KeyRotator(GEMINI_KEYS)
+gemini_rotator = KeyRotator(GEMINI_KEYS, GEMINI_RPM, GEMINI_TPM)
+hedge_executor = ThreadPoolExecutor(max_workers=16)
 
-def execute_gemini_action(action_callback):
+def _call_with_key(action_callback, key):
+    t0 = time.perf_counter()
+    try:
+        result = action_callback(key)
+    except Exception as e:
+        logging.warning(f"Gemini error with key {gemini_rotator.labels.get(key)}: {e}")
+        gemini_rotator.mark_failure(key, e)
+        metrics.inc("asr_gemini_errors_total", kind=classify_gemini_error(e))
+        raise
+    finally:
+        metrics.observe("gemini", time.perf_counter() - t0)
+    gemini_rotator.mark_success(key)
+    return result
+
+def _hedged_call(action_callback, key, tokens):
+    if GEMINI_HEDGE_AFTER <= 0:
+        return _call_with_key(action_callback, key)
+    first = hedge_executor.submit(_call_with_key, action_callback, key)
+    try:
+        return first.result(timeout=GEMINI_HEDGE_AFTER)
+    except FutureTimeout:
+        pass
+    backup = gemini_rotator.get_key(tokens, exclude=(key,))
+    if not backup:
+        return first.result()
+    second = hedge_executor.submit(_call_with_key, action_callback, backup)
+    last_exc = None
+    for future in as_completed([first, second]):
+        try:
+            return future.result()
+        except Exception as e:
+            last_exc = e
+    raise last_exc
+
+def execute_gemini_action(action_callback, tokens=0):
     last_exc = None
     total = len(gemini_rotator.keys) or 1
     for _ in range(total + 1):
-        key = gemini_rotator.get_key()
+        key = gemini_rotator.get_key(tokens)
         if not key:
-            raise RuntimeError("No Gemini keys available")
+            wait = gemini_rotator.next_ready()
+            if wait is None:
+                raise RuntimeError("No Gemini keys available")
+            if wait > GEMINI_MAX_WAIT:
+                break
+            time.sleep(wait + 0.05)
+            continue
         try:
-            result = action_callback(key)
-            gemini_rotator.mark_success(key)
-            return result
+            return _hedged_call(action_callback, key, tokens)
         except Exception as e:
             last_exc = e
-            logging.warning(f"Gemini error with key {str(key)[:4]}: {e}")
-            gemini_rotator.mark_failure(key)
+    if last_exc is None:
+        raise RuntimeError("All Gemini keys are busy, try again in a minute")
     raise RuntimeError(f"Gemini failed after rotations. Last error: {last_exc}")
 
 def ask_gemini(text, instruction):
@@ -128,7 +717,56 @@ def ask_gemini(text, instruction):
             return data["candidates"][0]["content"]["parts"][0]["text"]
         except Exception:
             raise RuntimeError("Unexpected Gemini response")
-    return execute_gemini_action(perform)
+    return execute_gemini_action(perform, tokens=(len(text) + len(instruction)) // 4)
+
+SENTENCE_END = re.compile(r'(?<=[.!?。！？؟])\s+')
+
+def split_text(text, limit):
+    pieces, current, size = [], [], 0
+    for sentence in SENTENCE_END.split(text):
+        while len(sentence) > limit:
+            cut = sentence.rfind(" ", 0, limit)
+            cut = cut if cut > 0 else limit
+            if current:
+                pieces.append(" ".join(current))
+                current, size = [], 0
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if current and size + 1 + len(sentence) > limit:
+            pieces.append(" ".join(current))
+            current, size = [], 0
+        if sentence:
+            current.append(sentence)
+            size += len(sentence) + 1
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def run_text_action(text, instruction, kind="summarize"):
+    if len(text) <= GEMINI_CHUNK_CHARS:
+        return ask_gemini(text, instruction)
+    pieces = split_text(text, GEMINI_CHUNK_CHARS)
+    if kind == "translate":
+        map_instruction = instruction
+    else:
+        map_instruction = "Summarize this part of a longer transcript in its original language, keeping every key point. No extra text — return only the summary."
+    with ThreadPoolExecutor(max_workers=min(GEMINI_PARALLEL, len(pieces))) as pool:
+        results = list(pool.map(lambda piece: ask_gemini(piece, map_instruction), pieces))
+    if kind == "translate":
+        return "\n".join(r.strip() for r in results)
+    combined = "\n\n".join(r.strip() for r in results)
+    if len(combined) > GEMINI_CHUNK_CHARS:
+        return run_text_action(combined, instruction, kind)
+    return ask_gemini(combined, "The following are summaries of consecutive parts of one transcript. " + instruction)
+
+def text_action_cached(text, instruction, kind, label):
+    key = "action:" + hashlib.sha256(text.encode("utf-8")).hexdigest() + ":" + label
+    result = transcript_cache.get(key)
+    if result is None:
+        result = run_text_action(text, instruction, kind)
+        if result:
+            transcript_cache.put(key, result)
+    return result
 
 def build_action_keyboard(text_len):
     btns = []
@@ -187,13 +825,21 @@ def mode_cb(call):
     if not ensure_joined(call.message):
         return
     mode = call.data.split("|")[1]
-    user_mode[call.from_user.id] = mode
+    state_store.set_pref("mode", call.from_user.id, mode)
     try:
         bot.edit_message_text(f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
         pass
     bot.answer_callback_query(call.id, f"Mode set to: {mode} ☑️")
 
+@bot.message_handler(commands=['stats'])
+def stats_command(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    c = transcript_cache.stats()
+    st = state_store.stats()
+    bot.reply_to(message, f"Cache: {c['hits']} hits, {c['misses']} misses, {c['entries']} entries ({c['bytes'] // 1024} KiB)\nQueue: {job_scheduler.depth()} parts waiting\nState: {st['prefs']} prefs, {st['transcripts']} transcripts, {st['pending']} pending files\nKeys: {gemini_rotator.stats()}")
+
 @bot.message_handler(commands=['lang'])
 def lang_command(message):
     if ensure_joined(message):
@@ -208,7 +854,7 @@ def lang_cb(call):
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         except:
             pass
-        process_text_action(call, origin, f"Translate to {lbl}", f"Translate this text in to language {lbl}. No extra text ONLY return the translated text.")
+        process_text_action(call, origin, f"Translate to {lbl}", f"Translate this text in to language {lbl}. No extra text ONLY return the translated text.", "translate")
         return
     try:
         bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -218,34 +864,30 @@ def lang_cb(call):
         except:
             pass
     chat_id = call.message.chat.id
-    user_selected_lang[chat_id] = code
+    state_store.set_pref("lang", chat_id, code)
     bot.answer_callback_query(call.id, f"Language set: {lbl} ☑️")
-    pending = pending_files.pop(chat_id, None)
+    pending = state_store.pop_pending(chat_id)
     if not pending:
         return
-    file_path = pending.get("path")
-    orig_msg = pending.get("message")
+    if pending.path.startswith(TG_FILE_PREFIX):
+        enqueue_media_job(chat_id, pending.message_id, pending.user_id, pending.path, pending.file_id, code)
+        return
     bot.send_chat_action(chat_id, 'typing')
     try:
-        text = transcribe_file(file_path, language=code, chat_id=chat_id, reply_id=orig_msg.id)
+        engine = asr_router.file_engine(code)
+        if engine:
+            with open(pending.path, 'rb') as f:
+                if submit_remote(engine, f, code, chat_id, pending.message_id, pending.user_id, pending.file_id):
+                    return
+        live = new_live_transcript(chat_id, pending.message_id, pending.user_id)
+        text = transcribe_cached(pending.path, language=code, unique_id=pending.file_id, chat_id=chat_id, reply_id=pending.message_id, live=live)
         if not text:
             raise ValueError("Empty transcription")
-        sent = send_long_text(chat_id, text, orig_msg.id, orig_msg.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = {"text": text, "origin": orig_msg.id}
-            if len(text) > 0:
-                try:
-                    bot.edit_message_reply_markup(chat_id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
-                except:
-                    pass
+        deliver_transcript(chat_id, text, pending.message_id, pending.user_id, live)
     except Exception as e:
         bot.send_message(chat_id, f"❌ Error: {e}")
     finally:
-        try:
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
-        except:
-            pass
+        _remove_file(pending.path)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('summarize_menu|'))
 def action_cb(call):
@@ -277,16 +919,16 @@ def summopt_cb(call):
         prompt = "Summarize this text in the original language as a bulleted list of main points. No extra text — return only the summary."
     process_text_action(call, origin, f"Summarize ({style})", prompt)
 
-def process_text_action(call, origin_msg_id, log_action, prompt_instr):
+def process_text_action(call, origin_msg_id, log_action, prompt_instr, kind="summarize"):
     chat_id = call.message.chat.id
     try:
         origin_id = int(origin_msg_id)
     except:
         origin_id = call.message.message_id
-    data = user_transcriptions.get(chat_id, {}).get(origin_id)
+    data = state_store.get_transcript(chat_id, origin_id)
     if not data:
         if call.message.reply_to_message:
-             data = user_transcriptions.get(chat_id, {}).get(call.message.reply_to_message.message_id)
+             data = state_store.get_transcript(chat_id, call.message.reply_to_message.message_id)
     if not data:
         bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
         return
@@ -294,170 +936,1221 @@ def process_text_action(call, origin_msg_id, log_action, prompt_instr):
     bot.answer_callback_query(call.id, "Processing...")
     bot.send_chat_action(chat_id, 'typing')
     try:
-        res = ask_gemini(text, prompt_instr)
+        res = text_action_cached(text, prompt_instr, kind, log_action)
         send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
     except Exception as e:
         bot.send_message(chat_id, f"Error: {e}")
 
-def download_file_from_telegram(file_info, dest_path):
-    file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-    with requests.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+class TranscriptCache(SQLiteStore):
+    schema = (
+        "CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts (accessed)",
+        "CREATE TABLE IF NOT EXISTS chunks (source TEXT NOT NULL, idx INTEGER NOT NULL, offset REAL NOT NULL, lang TEXT NOT NULL, text TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (source, idx, offset, lang))",
+    )
+    def __init__(self, path, ttl, max_bytes):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT text, created FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self.conn.execute("UPDATE transcripts SET accessed = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self.conn.execute("DELETE FROM transcripts WHERE key = ?", (key,))
+                self.conn.commit()
+            self.misses += 1
+            return None
+    def put(self, key, text):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO transcripts (key, text, size, created, accessed) VALUES (?, ?, ?, ?, ?)", (key, text, len(text.encode("utf-8")), now, now))
+            self._evict(now)
+            self.conn.commit()
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM transcripts WHERE created < ?", (now - self.ttl,))
+        self.conn.execute("DELETE FROM chunks WHERE created < ?", (now - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM transcripts ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM transcripts WHERE key = ?", (key,))
+                total -= size
+    def get_chunk(self, source, index, offset, language):
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM chunks WHERE source = ? AND idx = ? AND offset = ? AND lang = ?", (source, index, offset, language or "")).fetchone()
+            return row[0] if row else None
+    def put_chunk(self, source, index, offset, language, text):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO chunks (source, idx, offset, lang, text, created) VALUES (?, ?, ?, ?, ?, ?)", (source, index, offset, language or "", text, time.time()))
+            self.conn.commit()
+    def clear_chunks(self, source, language):
+        with self.lock:
+            self.conn.execute("DELETE FROM chunks WHERE source = ? AND lang = ?", (source, language or ""))
+            self.conn.commit()
+    def stats(self):
+        with self.lock:
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transcripts").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+transcript_cache = TranscriptCache(CACHE_DB, CACHE_TTL, CACHE_MAX_BYTES)
+
+def transcript_cache_key(file_id, language):
+    return f"{file_id}:{language or ''}"
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def transcribe_cached(file_path, language=None, unique_id=None, chat_id=None, reply_id=None, live=None, duration=None, feed=None):
+    stats = {}
+    def lookup():
+        stats["sha256"] = file_sha256(file_path)
+        return transcript_cache.get(transcript_cache_key(stats["sha256"], language))
+    if feed:
+        source = f"tg:{unique_id}" if unique_id else None
+        text = None
+    else:
+        text = lookup()
+        source = stats["sha256"]
+    complete = True
+    if text is None:
+        text = transcribe_file(file_path, language=language, chat_id=chat_id, reply_id=reply_id, source_id=source, stats=stats, live=live, duration=duration, feed=feed, lookup=lookup if feed else None)
+        complete = not stats.get("failed_chunks")
+        if text and complete and not stats.get("cached"):
+            transcript_cache.put(transcript_cache_key(stats.get("sha256") or file_sha256(file_path), language), text)
+    if text and complete and unique_id:
+        transcript_cache.put(transcript_cache_key(unique_id, language), text)
+    return text
+
+def download_file_from_telegram(file_info, dest_path, sink=None):
+    file_url = f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}/{file_info.file_path}"
+    with metrics.timed("download"), http_session.get(file_url, stream=True, timeout=http_timeout(file_url)) as r:
         r.raise_for_status()
         with open(dest_path, 'wb') as f:
             for chunk in r.iter_content(chunk_size=65536):
                 if chunk:
                     f.write(chunk)
+                    if sink:
+                        try:
+                            sink.write(chunk)
+                        except (BrokenPipeError, ValueError, OSError):
+                            sink = None
     return dest_path
 
+def telegram_file_chunks(file_info):
+    file_url = f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}/{file_info.file_path}"
+    with metrics.timed("download"), http_session.get(file_url, stream=True, timeout=http_timeout(file_url)) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=65536):
+            if chunk:
+                yield chunk
+
+def download_feed(file_info, dest_path):
+    return functools.partial(download_file_from_telegram, file_info, dest_path)
+
+class _Feeder(threading.Thread):
+    def __init__(self, feed, sink):
+        super().__init__(daemon=True)
+        self.feed = feed
+        self.sink = sink
+        self.error = None
+    def run(self):
+        try:
+            self.feed(sink=self.sink)
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.sink.close()
+            except:
+                pass
+
 def get_audio_duration(file_path):
     cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', file_path]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with metrics.timed("ffprobe"):
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     try:
         return float(result.stdout)
     except:
         return 0.0
 
-def process_chunk(chunk_index, start, chunk_duration, original_file, language):
-    temp_chunk_file = os.path.join(DOWNLOADS_DIR, f"temp_{os.path.basename(original_file)}_{chunk_index}.wav")
-    actual_start = max(0, start - CHUNK_OVERLAP)
-    actual_duration = chunk_duration + (CHUNK_OVERLAP if start > 0 else 0)
-    r_local = sr.Recognizer()
-    text_result = ""
-    try:
-        cmd = [
-            'ffmpeg', '-y',
-            '-ss', str(actual_start),
-            '-t', str(actual_duration),
-            '-i', original_file,
-            '-f', 'lavfi', '-i', f'anullsrc=channel_layout=mono:sample_rate=16000',
-            '-filter_complex', f'[1:a]atrim=end={SILENCE_PADDING}[sil];[sil][0:a]concat=n=2:v=0:a=1[out]',
-            '-map', '[out]',
-            '-ar', '16000', '-ac', '1',
-            temp_chunk_file
-        ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if os.path.exists(temp_chunk_file) and os.path.getsize(temp_chunk_file) > 100:
-            with sr.AudioFile(temp_chunk_file) as source:
-                audio_data = r_local.record(source)
+def _read_full(stream, view):
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got - got % PCM_WIDTH
+
+def _frame_energy(block):
+    samples = np.frombuffer(block, dtype='<i2')
+    frames = samples[:len(samples) - len(samples) % VAD_FRAME].reshape(-1, VAD_FRAME).astype(np.float32)
+    return np.sqrt((frames * frames).mean(axis=1))
+
+def _silence_runs(rms, carry):
+    if not VAD_ENABLED or len(rms) == 0:
+        return np.zeros(len(rms), dtype=np.int64)
+    threshold = max(VAD_MIN_RMS, min(VAD_THRESHOLD, 0.25 * float(np.percentile(rms, 90))))
+    silent = rms < threshold
+    idx = np.arange(len(rms))
+    last_voiced = np.maximum.accumulate(np.where(silent, -1 - carry, idx))
+    return np.where(silent, idx - last_voiced, 0)
+
+def _open_decoder(file_path, feed=None):
+    source = 'pipe:0' if feed else file_path
+    cmd = ['ffmpeg', '-v', 'error', '-i', source, '-map', '0:a:0', '-vn', '-sn', '-dn', '-ac', '1', '-ar', str(PCM_RATE), '-f', 's16le', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+    feeder = None
+    if feed:
+        feeder = _Feeder(feed, proc.stdin)
+        feeder.start()
+    return proc, feeder
+
+def _close_decoder(proc, feeder):
+    proc.stdout.close()
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    if feeder:
+        feeder.join()
+
+def _read_limited(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(min(65536, size - len(data)))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+def decode_pcm(file_path, feed=None, limit=None):
+    with metrics.timed("decode"):
+        proc, feeder = _open_decoder(file_path, feed)
+        try:
+            pcm = _read_limited(proc.stdout, limit + 1) if limit else proc.stdout.read()
+        finally:
+            _close_decoder(proc, feeder)
+    if feeder and feeder.error:
+        raise feeder.error
+    if not pcm and feeder:
+        return decode_pcm(file_path, limit=limit)
+    metrics.inc("asr_decoded_audio_seconds_total", len(pcm) / (PCM_RATE * PCM_WIDTH))
+    return pcm
+
+def stream_pcm_chunks(file_path, chunk_seconds=CHUNK_SECONDS, stats=None, feed=None, overlap=None, padding=None):
+    frame_bytes = VAD_FRAME * PCM_WIDTH
+    frames_per_sec = PCM_RATE / VAD_FRAME
+    target = max(1, int(chunk_seconds * frames_per_sec))
+    search = min(target, int(VAD_SEARCH_SECONDS * frames_per_sec))
+    keep = int(VAD_KEEP_SILENCE * frames_per_sec)
+    min_pause = max(1, int(VAD_MIN_PAUSE * frames_per_sec))
+    overlap = int((CHUNK_OVERLAP if overlap is None else overlap) * PCM_RATE) * PCM_WIDTH
+    pad = bytes(int(SILENCE_PADDING if padding is None else padding) * PCM_RATE * PCM_WIDTH)
+    block = bytearray(frame_bytes * max(1, int(VAD_BLOCK_SECONDS * frames_per_sec)))
+    view = memoryview(block)
+    audio = bytearray()
+    pauses = np.zeros(0, dtype=np.int64)
+    positions = np.zeros(0, dtype=np.int64)
+    decoded = 0
+    carry = 0
+    prefix = b""
+    index = 0
+    if stats is None:
+        stats = {}
+    stats.setdefault("decoded_seconds", 0.0)
+    stats.setdefault("sent_seconds", 0.0)
+    proc, feeder = _open_decoder(file_path, feed)
+    busy = 0.0
+    try:
+        eof = False
+        while not eof:
+            t0 = time.perf_counter()
+            got = _read_full(proc.stdout, view)
+            eof = got < len(block)
+            if eof and feeder:
+                feeder.join()
+                if feeder.error:
+                    raise feeder.error
+                if not decoded and not got:
+                    proc.stdout.close()
+                    proc.wait()
+                    proc, feeder = _open_decoder(file_path)
+                    eof = False
+                    continue
+                feeder = None
+            got -= got % frame_bytes
+            if got:
+                rms = _frame_energy(view[:got])
+                runs = _silence_runs(rms, carry)
+                carry = int(runs[-1])
+                kept = runs <= keep
+                frames = np.frombuffer(view[:got], dtype=np.uint8).reshape(-1, frame_bytes)
+                audio += frames[kept].tobytes()
+                pauses = np.concatenate([pauses, runs[kept]])
+                positions = np.concatenate([positions, np.nonzero(kept)[0] + decoded])
+                decoded += len(rms)
+                stats["decoded_seconds"] = decoded / frames_per_sec
+                del rms, frames
+            busy += time.perf_counter() - t0
+            while len(pauses) >= target or (eof and len(pauses)):
+                cut = len(pauses)
+                forced = False
+                if cut >= target:
+                    cut = target
+                    quiet = np.nonzero(pauses[target - search:target] >= min_pause)[0]
+                    if len(quiet):
+                        cut = target - search + int(quiet[-1]) + 1
+                    else:
+                        forced = True
+                speech = audio[:cut * frame_bytes]
+                voiced = bool((pauses[:cut] == 0).any())
+                offset = max(0.0, positions[0] / frames_per_sec - len(prefix) / (PCM_RATE * PCM_WIDTH))
+                del audio[:cut * frame_bytes]
+                pauses = pauses[cut:]
+                positions = positions[cut:]
+                if voiced:
+                    stats["sent_seconds"] += (len(prefix) + len(speech)) / (PCM_RATE * PCM_WIDTH)
+                    yield index, round(float(offset), 2), pad + prefix + speech, bool(prefix)
+                    index += 1
+                prefix = bytes(speech[-overlap:]) if forced and overlap else b""
+    finally:
+        _close_decoder(proc, feeder)
+        metrics.observe("decode", busy)
+        metrics.inc("asr_decoded_audio_seconds_total", decoded / frames_per_sec)
+
+class SchedulerBusy(RuntimeError):
+    pass
+
+class JobScheduler:
+    def __init__(self, workers, max_jobs):
+        self.queues = OrderedDict()
+        self.running = Counter()
+        self.jobs = 0
+        self.max_jobs = max_jobs
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.workers = workers
+        self.threads = []
+    def _start(self):
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+    def admit(self):
+        with self.cond:
+            if self.jobs >= self.max_jobs:
+                raise SchedulerBusy("Too many files in progress, please try again in a few minutes")
+            self.jobs += 1
+    def release(self):
+        with self.cond:
+            self.jobs = max(0, self.jobs - 1)
+    def submit(self, owner, fn, *args):
+        fut = Future()
+        with self.cond:
+            self._start()
+            self.queues.setdefault(owner, deque()).append((fut, fn, args))
+            self.pending += 1
+            self.cond.notify()
+        return fut
+    def depth(self):
+        with self.cond:
+            return self.pending
+    def position(self, owner):
+        with self.cond:
+            if owner not in self.queues or self.running[owner]:
+                return None
+            return list(self.queues).index(owner)
+    def _next(self):
+        owner, q = next(iter(self.queues.items()))
+        item = q.popleft()
+        if q:
+            self.queues.move_to_end(owner)
+        else:
+            del self.queues[owner]
+        self.pending -= 1
+        self.running[owner] += 1
+        return owner, item
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queues:
+                    self.cond.wait()
+                owner, (fut, fn, args) = self._next()
             try:
-                if language:
-                    text_result = r_local.recognize_google(audio_data, language=language)
-                else:
-                    text_result = r_local.recognize_google(audio_data)
-            except (sr.UnknownValueError, sr.RequestError):
-                pass
-    except Exception as e:
-        logging.error("Error in chunk %s: %s", chunk_index, e)
+                if fut.set_running_or_notify_cancel():
+                    try:
+                        fut.set_result(fn(*args))
+                    except BaseException as e:
+                        fut.set_exception(e)
+            finally:
+                with self.cond:
+                    self.running[owner] -= 1
+                    if self.running[owner] <= 0:
+                        del self.running[owner]
+
+job_scheduler = JobScheduler(MAX_CONCURRENT_CHUNKS, MAX_ACTIVE_JOBS)
+update_executor = ThreadPoolExecutor(max_workers=MAX_UPDATE_WORKERS)
+update_slots = threading.BoundedSemaphore(MAX_UPDATE_WORKERS + MAX_UPDATE_BACKLOG)
+
+class EngineError(RuntimeError):
+    pass
+
+class ModelPool:
+    def __init__(self, instances):
+        self.items = queue.Queue()
+        for inst in instances:
+            self.items.put(inst)
+    def acquire(self):
+        return self.items.get()
+    def release(self, inst):
+        self.items.put(inst)
+
+class GoogleEngine:
+    name = "google"
+    def load(self):
+        pass
+    def configured(self, language):
+        return True
+    def supports(self, language):
+        return True
+    def transcribe(self, pcm, language):
+        r_local = sr.Recognizer()
+        audio_data = sr.AudioData(pcm, PCM_RATE, PCM_WIDTH)
+        try:
+            if language:
+                return r_local.recognize_google(audio_data, language=language)
+            return r_local.recognize_google(audio_data)
+        except sr.UnknownValueError:
+            return ""
+        except sr.RequestError as e:
+            raise EngineError(str(e))
+
+class VoskEngine:
+    name = "vosk"
+    def __init__(self, models):
+        self.paths = dict(item.split(":", 1) for item in models.split(",") if ":" in item)
+        self.pools = {}
+    def load(self):
+        from vosk import Model
+        for lang, path in self.paths.items():
+            model = Model(path)
+            self.pools[lang] = ModelPool([model] * ENGINE_POOL_SIZE)
+    def configured(self, language):
+        return language in self.paths
+    def supports(self, language):
+        return language in self.pools
+    def transcribe(self, pcm, language):
+        from vosk import KaldiRecognizer
+        pool = self.pools[language]
+        model = pool.acquire()
+        try:
+            rec = KaldiRecognizer(model, PCM_RATE)
+            rec.SetWords(False)
+            result_text = []
+            view = memoryview(pcm)
+            for i in range(0, len(view), 8000):
+                if rec.AcceptWaveform(bytes(view[i:i + 8000])):
+                    res = json.loads(rec.Result())
+                    if res.get("text"):
+                        result_text.append(res["text"])
+            final_res = json.loads(rec.FinalResult())
+            if final_res.get("text"):
+                result_text.append(final_res["text"])
+            return " ".join(result_text).strip()
+        finally:
+            pool.release(model)
+
+class WhisperEngine:
+    name = "whisper"
+    def __init__(self):
+        self.pool = None
+    def load(self):
+        from faster_whisper import WhisperModel
+        self.pool = ModelPool([WhisperModel(model_size_or_path=WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE) for _ in range(ENGINE_POOL_SIZE)])
+    def configured(self, language):
+        return True
+    def supports(self, language):
+        return self.pool is not None
+    def transcribe(self, pcm, language):
+        model = self.pool.acquire()
+        try:
+            audio = np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768.0
+            segments, _ = model.transcribe(audio, language=language)
+            return "".join(s.text for s in segments).strip()
+        finally:
+            self.pool.release(model)
+
+def assemblyai_call(kind, method, path, key, **kwargs):
+    url = f"{ASSEMBLYAI_API_BASE}/v2/{path}"
+    metrics.inc("asr_assemblyai_requests_total", kind=kind)
+    resp = http_session.request(method, url, headers={"authorization": key}, timeout=http_timeout(url), **kwargs)
+    resp.raise_for_status()
+    return resp.json()
+
+class AssemblyAITracker:
+    def __init__(self, min_delay, max_delay, timeout):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.thread = None
+    def track(self, transcript_id, key, webhook=False):
+        fut = Future()
+        now = time.time()
+        delay = self.max_delay if webhook else self.min_delay
+        with self.cond:
+            self.jobs[transcript_id] = {"future": fut, "key": key, "next": now + delay, "delay": delay, "deadline": now + self.timeout}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return fut
+    def complete(self, transcript_id):
+        with self.cond:
+            job = self.jobs.get(transcript_id)
+            if job:
+                job["next"] = 0.0
+                self.cond.notify()
+        return job is not None
+    def in_flight(self):
+        with self.cond:
+            return len(self.jobs)
+    def _due(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                due = {}
+                if any(job["next"] <= now for job in self.jobs.values()):
+                    horizon = now + self.min_delay / 2
+                    for tid, job in self.jobs.items():
+                        if job["next"] <= horizon:
+                            due.setdefault(job["key"], []).append(tid)
+                    return due
+                wake = min((job["next"] for job in self.jobs.values()), default=None)
+                self.cond.wait(None if wake is None else wake - now)
+    def _run(self):
+        while True:
+            for key, ids in self._due().items():
+                try:
+                    self._check(key, ids)
+                except Exception as e:
+                    logging.exception("AssemblyAI status check failed: %s", e)
+                    for tid in ids:
+                        self._reschedule(tid)
+    def _check(self, key, ids):
+        statuses = {}
+        if len(ids) > 1:
+            try:
+                listing = assemblyai_call("list", "GET", "transcript", key, params={"limit": ASSEMBLYAI_POLL_BATCH})
+                statuses = {t["id"]: t["status"] for t in listing.get("transcripts", [])}
+            except Exception as e:
+                logging.warning("AssemblyAI list failed: %s", e)
+        for tid in ids:
+            status = statuses.get(tid)
+            data = None
+            if status in (None, "completed", "error"):
+                try:
+                    data = assemblyai_call("status", "GET", f"transcript/{tid}", key)
+                    status = data.get("status")
+                except Exception as e:
+                    logging.warning("AssemblyAI status for %s failed: %s", tid, e)
+                if data is None:
+                    self._reschedule(tid)
+                    continue
+            if status == "completed":
+                self._finish(tid, result=data.get("text") or "")
+            elif status == "error":
+                self._finish(tid, error=EngineError(f"AssemblyAI: {data.get('error')}"))
+            else:
+                self._reschedule(tid)
+    def _reschedule(self, tid):
+        with self.cond:
+            job = self.jobs.get(tid)
+            if not job:
+                return
+            now = time.time()
+            if now < job["deadline"]:
+                job["delay"] = min(self.max_delay, job["delay"] * 2)
+                job["next"] = now + job["delay"]
+                return
+        self._finish(tid, error=EngineError("AssemblyAI transcription timed out"))
+    def _finish(self, tid, result=None, error=None):
+        with self.cond:
+            job = self.jobs.pop(tid, None)
+        if not job:
+            return
+        if error is not None:
+            job["future"].set_exception(error)
+        else:
+            job["future"].set_result(result)
+
+assemblyai_tracker = AssemblyAITracker(ASSEMBLYAI_POLL_MIN, ASSEMBLYAI_POLL_MAX, ASSEMBLYAI_TIMEOUT)
+
+class AssemblyAIEngine:
+    name = "assemblyai"
+    def __init__(self, keys):
+        self.rotator = KeyRotator(keys)
+    def load(self):
+        if not self.rotator.keys:
+            raise EngineError("ASSEMBLYAI_KEYS is not set")
+    def configured(self, language):
+        return bool(self.rotator.keys)
+    def supports(self, language):
+        return False
+    def submit(self, audio, language):
+        key = self.rotator.get_key()
+        if not key:
+            raise EngineError("No AssemblyAI key available")
+        payload = {"language_code": language} if language else {"language_detection": True}
+        if ASSEMBLYAI_WEBHOOK_URL:
+            payload["webhook_url"] = ASSEMBLYAI_WEBHOOK_URL
+            if ASSEMBLYAI_WEBHOOK_SECRET:
+                payload.update(webhook_auth_header_name="X-Webhook-Secret", webhook_auth_header_value=ASSEMBLYAI_WEBHOOK_SECRET)
+        try:
+            with metrics.timed("upload", engine=self.name):
+                payload["audio_url"] = assemblyai_call("upload", "POST", "upload", key, data=audio)["upload_url"]
+            transcript_id = assemblyai_call("create", "POST", "transcript", key, json=payload)["id"]
+        except Exception as e:
+            self.rotator.mark_failure(key, e)
+            raise EngineError(f"AssemblyAI submit failed: {e}")
+        self.rotator.mark_success(key)
+        return assemblyai_tracker.track(transcript_id, key, webhook=bool(ASSEMBLYAI_WEBHOOK_URL))
+
+_worker_engine = None
+
+def _asr_worker_init(factory):
+    global _worker_engine, ENGINE_POOL_SIZE
+    ENGINE_POOL_SIZE = 1
+    _worker_engine = factory()
+    _worker_engine.load()
+
+def _asr_worker_ping(_):
+    return os.getpid()
+
+def _asr_worker_run(shm_name, size, language):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    view = shm.buf[:size]
+    try:
+        return _worker_engine.transcribe(view, language)
     finally:
-        if os.path.exists(temp_chunk_file):
+        view.release()
+        shm.close()
+
+def local_asr_process_count():
+    if LOCAL_ASR_PROCESSES == "auto":
+        return max(1, len(os.sched_getaffinity(0)) - 1)
+    return int(LOCAL_ASR_PROCESSES)
+
+class ProcessEngine:
+    def __init__(self, factory, workers):
+        self.factory = factory
+        self.inner = factory()
+        self.name = self.inner.name
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+    def load(self):
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"), initializer=_asr_worker_init, initargs=(self.factory,))
+        try:
+            list(executor.map(_asr_worker_ping, range(self.workers)))
+        except Exception:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        self.executor = executor
+    def configured(self, language):
+        return self.inner.configured(language)
+    def supports(self, language):
+        return self.inner.configured(language)
+    def _restart(self, broken):
+        with self.lock:
+            if self.executor is not broken:
+                return
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
             try:
-                os.remove(temp_chunk_file)
-            except:
-                pass
+                self.load()
+                logging.info("ASR engine %s worker pool restarted", self.name)
+            except Exception as e:
+                logging.error("ASR engine %s worker pool restart failed: %s", self.name, e)
+    def transcribe(self, pcm, language):
+        executor = self.executor
+        if executor is None:
+            self._restart(None)
+            executor = self.executor
+            if executor is None:
+                raise EngineError(f"{self.name} worker pool is not running")
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(pcm)))
+        try:
+            shm.buf[:len(pcm)] = pcm
+            return executor.submit(_asr_worker_run, shm.name, len(pcm), language).result()
+        except BrokenProcessPool as e:
+            self._restart(executor)
+            raise EngineError(f"{self.name} worker pool broke: {e}")
+        finally:
+            shm.close()
+            shm.unlink()
+
+def build_local_engine(factory):
+    workers = local_asr_process_count()
+    return ProcessEngine(factory, workers) if workers > 0 else factory()
+
+class EngineRouter:
+    def __init__(self, engines, default, routes):
+        self.engines = {e.name: e for e in engines}
+        self.default = [n.strip() for n in default.split("|") if n.strip()]
+        self.routes = {}
+        for item in routes.split(","):
+            if ":" in item:
+                lang, names = item.split(":", 1)
+                self.routes[lang.strip()] = [n.strip() for n in names.split("|") if n.strip()]
+        self.health = {name: {"failures": 0, "until": 0.0, "rtf": 0.0, "calls": 0} for name in self.engines}
+        self.loaded = set()
+        self.failed = {}
+        self.attempted = False
+        self.lock = threading.Lock()
+    def load(self):
+        with self.lock:
+            self.attempted = True
+            names = set(self.default)
+            for names_for_lang in self.routes.values():
+                names.update(names_for_lang)
+            for name in names:
+                if name in self.loaded or name in self.failed or name not in self.engines:
+                    continue
+                try:
+                    self.engines[name].load()
+                    self.loaded.add(name)
+                    logging.info("ASR engine %s loaded", name)
+                except Exception as e:
+                    self.failed[name] = str(e)
+                    logging.warning("ASR engine %s failed to load: %s", name, e)
+    def order(self, language):
+        if not self.attempted:
+            self.load()
+        names = self.routes.get(language) or self.default
+        now = time.time()
+        usable = [n for n in names if n in self.loaded and self.engines[n].supports(language)]
+        healthy = [n for n in usable if self.health[n]["until"] <= now]
+        return healthy + [n for n in usable if n not in healthy]
+    def _record(self, name, ok, rtf=None):
+        with self.lock:
+            h = self.health[name]
+            h["calls"] += 1
+            if ok:
+                h["failures"] = 0
+                h["rtf"] = rtf if not h["rtf"] else 0.8 * h["rtf"] + 0.2 * rtf
+                if h["rtf"] > ENGINE_SLOW_RTF:
+                    h["until"] = time.time() + ENGINE_COOLDOWN
+            else:
+                h["failures"] += 1
+                h["until"] = time.time() + ENGINE_COOLDOWN * min(8, 2 ** (h["failures"] - 1))
+    def file_engine(self, language):
+        if not self.attempted:
+            self.load()
+        names = [n for n in self.routes.get(language) or self.default if n in self.loaded and self.engines[n].configured(language)]
+        now = time.time()
+        names = [n for n in names if self.health[n]["until"] <= now] or names
+        return self.engines[names[0]] if names and hasattr(self.engines[names[0]], "submit") else None
+    def expected_rtf(self, language):
+        names = self.order(language)
+        return self.health[names[0]]["rtf"] if names else 0.0
+    def transcribe(self, pcm, language):
+        seconds = max(0.001, len(pcm) / (PCM_RATE * PCM_WIDTH))
+        last_exc = None
+        for name in self.order(language):
+            t0 = time.time()
+            try:
+                text = self.engines[name].transcribe(pcm, language)
+            except Exception as e:
+                last_exc = e
+                logging.warning("ASR engine %s failed: %s", name, e)
+                self._record(name, False)
+                metrics.inc("asr_engine_failures_total", engine=name)
+                continue
+            metrics.observe("recognize", time.time() - t0, engine=name)
+            metrics.inc("asr_recognized_audio_seconds_total", seconds)
+            self._record(name, True, (time.time() - t0) / seconds)
+            return text
+        raise EngineError(f"No ASR engine succeeded for {language}. Last error: {last_exc}")
+
+asr_router = EngineRouter([GoogleEngine(), build_local_engine(functools.partial(VoskEngine, VOSK_MODELS)), build_local_engine(WhisperEngine), AssemblyAIEngine(ASSEMBLYAI_KEYS)], ASR_ENGINES, ASR_LANG_ENGINES)
+
+def process_chunk(chunk_index, pcm, language, retry_budget=None):
+    text_result = None
+    try:
+        if len(pcm) <= 100:
+            return (chunk_index, "")
+        for attempt in range(CHUNK_RETRIES + 1):
+            try:
+                text_result = asr_router.transcribe(pcm, language)
+                break
+            except EngineError as e:
+                if attempt == CHUNK_RETRIES or (retry_budget is not None and not retry_budget.acquire(blocking=False)):
+                    logging.warning("Chunk %s failed after %s attempts: %s", chunk_index, attempt + 1, e)
+                    metrics.inc("asr_chunk_failures_total")
+                    break
+                metrics.inc("asr_chunk_retries_total")
+                time.sleep(CHUNK_RETRY_DELAY * (2 ** attempt) + random.uniform(0, CHUNK_RETRY_DELAY))
+    except Exception as e:
+        logging.error("Error in chunk %s: %s", chunk_index, e)
     return (chunk_index, text_result)
 
-def _progress_updater_thread(chat_id, progress_message_id, done_event, label="Transcribing"):
-    percent = 0
+TOKEN_STRIP = re.compile(r"[^\w]+")
+
+def _norm_token(token):
+    return TOKEN_STRIP.sub("", token.lower())
+
+def overlap_length(tail, head, min_tokens=STITCH_MIN_TOKENS, slack=STITCH_SLACK):
+    best = best_end = 0
+    for end in range(max(0, len(tail) - 1 - slack), len(tail)):
+        for j in range(len(head)):
+            n = 0
+            while n <= min(end, j) and tail[end - n] and tail[end - n] == head[j - n]:
+                n += 1
+            if n >= min_tokens and n > best and j + 1 - n <= slack:
+                best, best_end = n, j + 1
+    return best_end
+
+class TranscriptStitcher:
+    def __init__(self, window=STITCH_WINDOW):
+        self.window = window
+        self.parts = []
+        self.tail = []
+    def add(self, text, overlapped=True):
+        tokens = text.split() if text else []
+        if overlapped:
+            tokens = tokens[overlap_length(self.tail, [_norm_token(t) for t in tokens[:self.window]]):]
+        if not tokens:
+            return ""
+        self.tail = (self.tail + [_norm_token(t) for t in tokens[-self.window:]])[-self.window:]
+        text = " ".join(tokens)
+        self.parts.append(text)
+        return text
+    def text(self):
+        return " ".join(self.parts)
+
+class LiveTranscript:
+    def __init__(self, chat_id, reply_id):
+        self.chat_id = chat_id
+        self.reply_id = reply_id
+        self.pending = []
+        self.messages = []
+        self.last_flush = 0.0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+    def append(self, text):
+        with self.lock:
+            self.pending.append(text)
+    def flush(self, force=False):
+        with self.send_lock:
+            with self.lock:
+                if not self.pending or (not force and time.time() - self.last_flush < STREAM_EDIT_INTERVAL):
+                    return
+                text = " ".join(self.pending)
+                self.pending = []
+                self.last_flush = time.time()
+            if self.messages and len(self.messages[-1][1]) + 1 + len(text) <= MAX_MESSAGE_CHUNK:
+                msg_id, current = self.messages[-1]
+                try:
+                    outbox.edit(self.chat_id, msg_id, current + " " + text).result()
+                    self.messages[-1] = (msg_id, current + " " + text)
+                    return
+                except:
+                    pass
+            for i in range(0, len(text), MAX_MESSAGE_CHUNK):
+                part = text[i:i + MAX_MESSAGE_CHUNK]
+                try:
+                    sent = outbox.call(self.chat_id, bot.send_message, self.chat_id, part, reply_to_message_id=self.reply_id)
+                except:
+                    with self.lock:
+                        self.pending.insert(0, text[i:])
+                    return
+                self.messages.append((sent.message_id, part))
+    def last_message_id(self):
+        return self.messages[-1][0] if self.messages else None
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def _progress_updater_thread(chat_id, progress_message_id, done_event, progress, live=None, label="Transcribing"):
     bars = 12
     bar_empty = "░"
     bar_full = "█"
+    last_text = f"{label}: 0% [{bar_empty * bars}]"
+    started = None
     try:
-        while not done_event.is_set():
-            increment = random.randint(6, 14)
-            percent = min(95, percent + increment)
-            filled = int(percent * bars / 100)
-            bar = bar_full * filled + bar_empty * (bars - filled)
-            text = f"{label}: {percent}% [{bar}]"
-            try:
-                bot.edit_message_text(text, chat_id, progress_message_id)
-            except:
-                pass
-            time.sleep(0.8)
-        percent = 100
+        while not done_event.wait(PROGRESS_INTERVAL):
+            position = job_scheduler.position(chat_id)
+            if position is not None:
+                text = f"⏳ Waiting in queue: {position} ahead of you ({job_scheduler.depth()} parts queued)"
+            else:
+                started = started or time.time()
+                done = progress["done"]
+                total = max(progress["total"], done)
+                percent = min(99, int(done * 100 / total)) if total else 0
+                filled = int(percent * bars / 100)
+                bar = bar_full * filled + bar_empty * (bars - filled)
+                text = f"{label}: {percent}% [{bar}]"
+                if total:
+                    text += f"\n{format_seconds(done)} / {format_seconds(total)}"
+                    elapsed = time.time() - started
+                    if done > 0 and elapsed > 0:
+                        text += f" · ETA {format_seconds((total - done) * elapsed / done)}"
+            if text != last_text:
+                outbox.edit(chat_id, progress_message_id, text)
+                last_text = text
+            if live:
+                live.flush()
         bar = bar_full * bars
-        final_text = f"{label}: {percent}% [{bar}] ✅"
-        try:
-            bot.edit_message_text(final_text, chat_id, progress_message_id)
-        except:
-            pass
+        final_text = f"{label}: 100% [{bar}] ✅"
+        outbox.edit(chat_id, progress_message_id, final_text)
         time.sleep(0.2)
-        try:
-            bot.delete_message(chat_id, progress_message_id)
-        except:
-            pass
+        outbox.delete(chat_id, progress_message_id)
     except:
         pass
 
-def transcribe_file(file_path, language=None, chat_id=None, reply_id=None):
-    duration = get_audio_duration(file_path)
-    if duration == 0:
+def plan_job(duration, language=None):
+    if not ADAPTIVE_PLAN:
+        return {"fast": False, "chunk": CHUNK_SECONDS, "overlap": CHUNK_OVERLAP, "padding": SILENCE_PADDING, "parallel": MAX_PENDING_CHUNKS}
+    if 0 < duration <= PLAN_FAST_SECONDS:
+        return {"fast": True, "chunk": duration, "overlap": 0.0, "padding": 0, "parallel": 1}
+    chunk = CHUNK_SECONDS
+    if duration:
+        chunk = min(CHUNK_SECONDS, max(PLAN_MIN_CHUNK, int(duration / (MAX_CONCURRENT_CHUNKS * PLAN_CHUNKS_PER_WORKER))))
+    share = max(1, MAX_CONCURRENT_CHUNKS // max(1, job_scheduler.jobs))
+    rtf = asr_router.expected_rtf(language)
+    parallel = share if rtf and chunk * rtf < PLAN_MIN_CALL_SECONDS else MAX_CONCURRENT_CHUNKS
+    if duration:
+        parallel = max(1, min(parallel, int(-(-duration // chunk))))
+    return {"fast": False, "chunk": chunk, "overlap": CHUNK_OVERLAP, "padding": SILENCE_PADDING, "parallel": parallel}
+
+def transcribe_short(pcm, language, owner, stats):
+    metrics.inc("asr_fast_path_total")
+    _, text = job_scheduler.submit(owner, process_chunk, 0, pcm, language).result()
+    if text is None:
+        stats["failed_chunks"] = 1
+        return ""
+    return text.strip()
+
+def transcribe_file(file_path, language=None, chat_id=None, reply_id=None, source_id=None, stats=None, live=None, duration=None, feed=None, lookup=None):
+    if feed:
+        duration = duration or 0
+    elif duration is None:
+        duration = get_audio_duration(file_path)
+    if duration == 0 and not feed:
         return ""
-    total_chunks = int((duration + CHUNK_SECONDS - 1) // CHUNK_SECONDS)
-    if total_chunks <= 0:
-        total_chunks = 1
+    job_scheduler.admit()
+    if stats is None:
+        stats = {}
+    owner = chat_id if chat_id is not None else file_path
+    progress = {"done": 0.0, "total": duration}
     progress_msg = None
     progress_done_event = threading.Event()
     progress_thread = None
     try:
+        plan = stats["plan"] = plan_job(duration, language)
+        if plan["fast"]:
+            limit = int(2 * PLAN_FAST_SECONDS * PCM_RATE) * PCM_WIDTH
+            pcm = decode_pcm(file_path, feed, limit)
+            text = lookup() if lookup else None
+            if text is not None:
+                stats["cached"] = True
+                return text
+            lookup = None
+            if len(pcm) <= limit:
+                return transcribe_short(pcm, language, owner, stats)
+            del pcm
+            feed = None
+            duration = progress["total"] = get_audio_duration(file_path)
+            plan = stats["plan"] = plan_job(duration, language)
+        total_chunks = max(1, int(-(-duration // plan["chunk"])))
+        if source_id:
+            source_id = f"{source_id}@{int(plan['chunk'])}"
         if chat_id is not None and reply_id is not None:
             try:
                 bars = 12
                 bar_empty = "░"
-                progress_msg = bot.send_message(chat_id, f"Transcribing: 0% [{bar_empty * bars}]", reply_to_message_id=reply_id)
-                progress_thread = threading.Thread(target=_progress_updater_thread, args=(chat_id, progress_msg.message_id, progress_done_event, "Transcribing"), daemon=True)
+                progress_msg = outbox.call(chat_id, bot.send_message, chat_id, f"Transcribing: 0% [{bar_empty * bars}]", reply_to_message_id=reply_id)
+                progress_thread = threading.Thread(target=_progress_updater_thread, args=(chat_id, progress_msg.message_id, progress_done_event, progress, live), daemon=True)
                 progress_thread.start()
             except:
                 progress_msg = None
         futures = []
-        results = []
+        stitcher = TranscriptStitcher()
+        ready = {}
+        next_index = [0]
         completed = 0
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for i in range(total_chunks):
-                start = i * CHUNK_SECONDS
-                futures.append(executor.submit(process_chunk, i, start, CHUNK_SECONDS, file_path, language))
-            for future in as_completed(futures):
-                try:
-                    res = future.result()
-                    results.append(res)
-                except Exception as e:
-                    logging.error("Thread exception: %s", e)
+        spans = {}
+        overlapped = {}
+        finished = set()
+        lock = threading.Lock()
+        def credit(i, span):
+            with lock:
+                if i in finished:
+                    progress["done"] += span
+                else:
+                    spans[i] = span
+        def collect(i, text):
+            with lock:
+                finished.add(i)
+                progress["done"] += spans.pop(i, 0.0)
+                ready[i] = text
+                while next_index[0] in ready:
+                    text = ready.pop(next_index[0])
+                    next_index[0] += 1
+                    clean_text = stitcher.add(text, overlapped.pop(next_index[0] - 1, False))
+                    if clean_text and live:
+                        live.append(clean_text)
+        slots = threading.BoundedSemaphore(plan["parallel"])
+        retry_budget = threading.Semaphore(max(CHUNK_RETRIES, total_chunks // 2))
+        def run_chunk(i, offset, chunk):
+            try:
+                res = process_chunk(i, chunk, language, retry_budget)
+                if source_id and res[1] is not None:
+                    transcript_cache.put_chunk(source_id, i, offset, language, res[1])
+                collect(i, res[1])
+                return res
+            finally:
+                slots.release()
+        decode_stats = {}
+        last = None
+        for i, offset, chunk, forced in stream_pcm_chunks(file_path, plan["chunk"], stats=decode_stats, feed=feed, overlap=plan["overlap"], padding=plan["padding"]):
+            progress["total"] = max(progress["total"], decode_stats["decoded_seconds"])
+            with lock:
+                overlapped[i] = forced
+            if last:
+                credit(last[0], offset - last[1])
+            else:
+                with lock:
+                    progress["done"] += offset
+            last = (i, offset)
+            saved = transcript_cache.get_chunk(source_id, i, offset, language) if source_id else None
+            if saved is not None:
+                collect(i, saved)
                 completed += 1
-                try:
-                    if progress_msg:
-                        percent = int((completed / total_chunks) * 100)
-                        if percent > 99:
-                            percent = 99
-                        bars = 12
-                        filled = int(percent * bars / 100)
-                        bar_full = "█"
-                        bar_empty = "░"
-                        bar = bar_full * filled + bar_empty * (bars - filled)
-                        bot.edit_message_text(f"Transcribing: {percent}% [{bar}]", chat_id, progress_msg.message_id)
-                except:
-                    pass
-        results.sort(key=lambda x: x[0])
-        full_text = ""
-        seen_text = set()
-        for _, text in results:
-            if text:
-                clean_text = text.strip()
-                if clean_text not in seen_text:
-                    full_text += clean_text + " "
-                    seen_text.add(clean_text)
-        full_text = full_text.strip()
+                continue
+            slots.acquire()
+            futures.append(job_scheduler.submit(owner, run_chunk, i, offset, chunk))
+            del chunk
+        progress["total"] = decode_stats.get("decoded_seconds") or progress["total"]
+        text = lookup() if lookup else None
+        if text is not None:
+            with lock:
+                if live and next_index[0]:
+                    text = None
+                else:
+                    next_index[0] = -1
+        if text is not None:
+            stats["cached"] = True
+            for future in futures:
+                future.cancel()
+            if source_id:
+                transcript_cache.clear_chunks(source_id, language)
+            return text
+        if last:
+            credit(last[0], max(0.0, progress["total"] - last[1]))
+        total_chunks = (len(futures) + completed) or 1
+        for future in as_completed(futures):
+            try:
+                res = future.result()
+            except Exception as e:
+                logging.error("Thread exception: %s", e)
+                res = (None, None)
+            if res[1] is None:
+                stats["failed_chunks"] = stats.get("failed_chunks", 0) + 1
+        full_text = stitcher.text()
+        if stats.get("failed_chunks"):
+            logging.warning("%s of %s chunks failed for %s", stats["failed_chunks"], total_chunks, file_path)
+        elif source_id:
+            transcript_cache.clear_chunks(source_id, language)
         return full_text
     finally:
+        job_scheduler.release()
         try:
             progress_done_event.set()
             if progress_thread:
                 progress_thread.join(timeout=1.0)
             if progress_msg:
-                try:
-                    bot.delete_message(chat_id, progress_msg.message_id)
-                except:
-                    pass
+                outbox.delete(chat_id, progress_msg.message_id)
+        except:
+            pass
+        if live:
+            live.flush(force=True)
+
+def deliver_transcript(chat_id, text, reply_id, uid, live=None):
+    sent_id = live.last_message_id() if live else None
+    if sent_id is None:
+        sent = send_long_text(chat_id, text, reply_id, uid)
+        sent_id = sent.message_id if sent else None
+    if sent_id:
+        state_store.put_transcript(chat_id, sent_id, text, reply_id)
+        if len(text) > 0:
+            outbox.submit(chat_id, bot.edit_message_reply_markup, chat_id, sent_id, reply_markup=build_action_keyboard(len(text)))
+
+def new_live_transcript(chat_id, reply_id, uid):
+    if STREAM_RESULTS and get_user_mode(uid) == "Split messages":
+        return LiveTranscript(chat_id, reply_id)
+    return None
+
+def submit_remote(engine, audio, language, chat_id, reply_id, uid, unique_id=None, report_errors=True):
+    try:
+        progress_msg = outbox.call(chat_id, bot.send_message, chat_id, "🔄 Transcribing...", reply_to_message_id=reply_id)
+    except:
+        progress_msg = None
+    try:
+        future = engine.submit(audio, language)
+    except EngineError as e:
+        logging.warning("Remote engine %s rejected job, using local pipeline: %s", engine.name, e)
+        metrics.inc("asr_engine_failures_total", engine=engine.name)
+        if progress_msg:
+            outbox.delete(chat_id, progress_msg.message_id)
+        return None
+    done = Future()
+    future.add_done_callback(lambda f: update_executor.submit(_finish_remote, f, done, language, chat_id, reply_id, uid, unique_id, progress_msg, report_errors))
+    return done
+
+def _finish_remote(future, done, language, chat_id, reply_id, uid, unique_id, progress_msg, report_errors):
+    if progress_msg:
+        outbox.delete(chat_id, progress_msg.message_id)
+    try:
+        text = future.result()
+        if not text:
+            raise ValueError("I don't understand this voice 😓")
+        if unique_id:
+            transcript_cache.put(transcript_cache_key(unique_id, language), text)
+        deliver_transcript(chat_id, text, reply_id, uid)
+    except Exception as e:
+        done.set_exception(e)
+        if report_errors:
+            try:
+                bot.send_message(chat_id, f"Error: {e}", reply_to_message_id=reply_id)
+            except:
+                pass
+        return
+    done.set_result(text)
+
+def enqueue_media_job(chat_id, reply_id, user_id, file_ref, unique_id, language, duration=None):
+    notice_id = None
+    ahead = job_queue.depth()
+    if ahead:
+        try:
+            notice_id = bot.send_message(chat_id, f"⏳ Waiting in queue: {ahead} ahead of you", reply_to_message_id=reply_id).message_id
         except:
             pass
+    payload = {"chat_id": chat_id, "reply_id": reply_id, "user_id": user_id, "file": file_ref, "unique_id": unique_id, "language": language, "duration": duration, "notice_id": notice_id}
+    return job_queue.put("media", payload)
+
+def run_media_job(job):
+    p = job["payload"]
+    chat_id = p["chat_id"]
+    reply_id = p["reply_id"]
+    if p.get("notice_id"):
+        try:
+            bot.delete_message(chat_id, p["notice_id"])
+        except:
+            pass
+    file_info = bot.get_file(p["file"][len(TG_FILE_PREFIX):])
+    engine = asr_router.file_engine(p["language"])
+    if engine:
+        pending = submit_remote(engine, telegram_file_chunks(file_info), p["language"], chat_id, reply_id, p["user_id"], p["unique_id"], report_errors=False)
+        if pending:
+            return pending
+    ext = os.path.splitext(file_info.file_path)[1] if '.' in file_info.file_path else ''
+    dest_path = os.path.join(DOWNLOADS_DIR, f"job_{job['id']}_{p['unique_id']}{ext}")
+    try:
+        live = new_live_transcript(chat_id, reply_id, p["user_id"])
+        text = transcribe_cached(dest_path, language=p["language"], unique_id=p["unique_id"], chat_id=chat_id, reply_id=reply_id, live=live, duration=p.get("duration"), feed=download_feed(file_info, dest_path))
+        if not text:
+            bot.send_message(chat_id, "I don't understand this voice 😓", reply_to_message_id=reply_id)
+            return
+        deliver_transcript(chat_id, text, reply_id, p["user_id"], live)
+    finally:
+        _remove_file(dest_path)
+
+def _job_heartbeat(job_id, owner, done):
+    while not done.wait(JOB_VISIBILITY / 3):
+        if not job_queue.touch(job_id, owner):
+            logging.warning("Lost lease on job %s", job_id)
+            return
+
+def notify_job_failed(job, error):
+    try:
+        bot.send_message(job["payload"]["chat_id"], f"Error: {error}", reply_to_message_id=job["payload"]["reply_id"])
+    except:
+        pass
+
+def _job_worker_loop(owner):
+    while True:
+        try:
+            for expired in job_queue.expire():
+                logging.error("Job %s timed out on its last attempt", expired["id"])
+                notify_job_failed(expired, "transcription timed out, please send the file again")
+            job = job_queue.claim(owner)
+        except Exception as e:
+            logging.error("Job claim failed: %s", e)
+            job = None
+        if not job:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        done = threading.Event()
+        threading.Thread(target=_job_heartbeat, args=(job["id"], owner, done), daemon=True).start()
+        try:
+            pending = run_media_job(job)
+        except Exception as e:
+            _finish_job(job, owner, done, e)
+            continue
+        if pending:
+            pending.add_done_callback(lambda f, job=job, done=done: _finish_job(job, owner, done, f.exception()))
+        else:
+            _finish_job(job, owner, done, None)
+
+def _finish_job(job, owner, done, error):
+    try:
+        if error is None:
+            job_queue.ack(job["id"], owner)
+            return
+        logging.error("Job %s failed on attempt %s: %s", job["id"], job["attempts"], error, exc_info=error)
+        if job_queue.fail(job["id"], owner, error):
+            notify_job_failed(job, error)
+    except Exception as e:
+        logging.error("Job %s could not be settled: %s", job["id"], e)
+    finally:
+        done.set()
+
+def start_job_workers(count=JOB_WORKERS):
+    threads = []
+    for i in range(count):
+        t = threading.Thread(target=_job_worker_loop, args=(f"{os.uname().nodename}:{os.getpid()}:{i}",), daemon=True)
+        t.start()
+        threads.append(t)
+    return threads
+
+def media_file_type(message):
+    if message.voice: return "Voice"
+    elif message.audio: return "Audio File"
+    elif message.video: return "Video"
+    elif message.document: return f"Document ({message.document.mime_type})"
+    return "Unknown"
 
 @bot.message_handler(content_types=['voice', 'audio', 'video', 'document'])
 def handle_media(message):
@@ -469,67 +2162,107 @@ def handle_media(message):
     if getattr(media, 'file_size', 0) > MAX_UPLOAD_SIZE:
         bot.reply_to(message, f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎 or use @MediaToTextBot")
         return
-    file_type = "Unknown"
-    if message.voice: file_type = "Voice"
-    elif message.audio: file_type = "Audio File"
-    elif message.video: file_type = "Video"
-    elif message.document: file_type = f"Document ({message.document.mime_type})"
-    notify_admin(message, file_type)
+    notify_admin(message, media_file_type(message))
     bot.send_chat_action(message.chat.id, 'typing')
     ext = ""
     file_path = os.path.join(DOWNLOADS_DIR, f"temp_{message.id}_{media.file_unique_id}")
+    dest_path = file_path
+    keep_file = False
+    live = None
     try:
-        file_info = bot.get_file(media.file_id)
-        if '.' in file_info.file_path:
-            ext = os.path.splitext(file_info.file_path)[1]
-        dest_path = file_path + (ext or '')
-        download_file_from_telegram(file_info, dest_path)
-        lang = user_selected_lang.get(message.chat.id)
-        if not lang:
-            pending_files[message.chat.id] = {"path": dest_path, "message": message}
-            kb = build_lang_keyboard("file")
-            bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=kb)
+        lang = state_store.get_pref("lang", message.chat.id)
+        text = transcript_cache.get(transcript_cache_key(media.file_unique_id, lang)) if lang else None
+        if text is None and BOT_ROLE == "ingress":
+            if not lang:
+                state_store.put_pending(message.chat.id, PendingFile(TG_FILE_PREFIX + media.file_id, message.id, message.from_user.id, media.file_unique_id))
+                bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=build_lang_keyboard("file"))
+            else:
+                enqueue_media_job(message.chat.id, message.id, message.from_user.id, TG_FILE_PREFIX + media.file_id, media.file_unique_id, lang, getattr(media, 'duration', None))
             return
-        text = transcribe_file(dest_path, language=lang, chat_id=message.chat.id, reply_id=message.id)
+        if text is None:
+            file_info = bot.get_file(media.file_id)
+            if '.' in file_info.file_path:
+                ext = os.path.splitext(file_info.file_path)[1]
+            dest_path = file_path + (ext or '')
+            if not lang:
+                download_file_from_telegram(file_info, dest_path)
+                state_store.put_pending(message.chat.id, PendingFile(dest_path, message.id, message.from_user.id, media.file_unique_id))
+                keep_file = True
+                kb = build_lang_keyboard("file")
+                bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=kb)
+                return
+            engine = asr_router.file_engine(lang)
+            if engine and submit_remote(engine, telegram_file_chunks(file_info), lang, message.chat.id, message.id, message.from_user.id, media.file_unique_id):
+                return
+            live = new_live_transcript(message.chat.id, message.id, message.from_user.id)
+            text = transcribe_cached(dest_path, language=lang, unique_id=media.file_unique_id, chat_id=message.chat.id, reply_id=message.id, live=live, duration=getattr(media, 'duration', None), feed=download_feed(file_info, dest_path))
         if not text:
             raise ValueError("I don't understand this voice 😓")
-        sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = {"text": text, "origin": message.id}
-            if len(text) > 0:
-                try:
-                    bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
-                except:
-                    pass
+        deliver_transcript(message.chat.id, text, message.id, message.from_user.id, live)
     except Exception as e:
         bot.reply_to(message, f"Error: {e}")
+    finally:
         try:
-            if os.path.exists(dest_path):
+            if not keep_file and os.path.exists(dest_path):
                 os.remove(dest_path)
         except:
             pass
 
+def send_text_document(chat_id, text, reply_id, action):
+    return bot.send_document(chat_id, io.BytesIO(text.encode("utf-8")), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id, visible_file_name=f"{action}.txt")
+
 def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
     mode = get_user_mode(uid)
     if len(text) > MAX_MESSAGE_CHUNK:
         if mode == "Split messages":
-            sent = None
-            for i in range(0, len(text), MAX_MESSAGE_CHUNK):
-                sent = bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
-            return sent
+            futures = [outbox.submit(chat_id, bot.send_message, chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id) for i in range(0, len(text), MAX_MESSAGE_CHUNK)]
+            return [f.result() for f in futures][-1]
         else:
-            fname = os.path.join(DOWNLOADS_DIR, f"{action}.txt")
-            with open(fname, "w", encoding="utf-8") as f:
-                f.write(text)
-            sent = bot.send_document(chat_id, open(fname, 'rb'), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
-            os.remove(fname)
-            return sent
-    return bot.send_message(chat_id, text, reply_to_message_id=reply_id)
+            return outbox.call(chat_id, send_text_document, chat_id, text, reply_id, action)
+    return outbox.call(chat_id, bot.send_message, chat_id, text, reply_to_message_id=reply_id)
 
 @flask_app.route("/", methods=["GET"])
 def index():
     return "Bot Running", 200
 
+def render_metrics():
+    lines = metrics.render()
+    gauges = {
+        "asr_queue_depth": job_scheduler.depth(),
+        "asr_active_jobs": job_scheduler.jobs,
+        "asr_update_backlog": update_queue.qsize() if update_queue else 0,
+        "asr_assemblyai_in_flight": assemblyai_tracker.in_flight(),
+        "telegram_outbox_depth": outbox.depth(),
+    }
+    c = transcript_cache.stats()
+    gauges.update({"asr_cache_entries": c["entries"], "asr_cache_bytes": c["bytes"]})
+    for name, value in state_store.stats().items():
+        gauges[f"asr_state_{name}"] = value
+    for name, value in job_queue.stats().items():
+        gauges[f"asr_jobs_{name}"] = value
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    lines += ["# TYPE asr_cache_hits_total counter", f"asr_cache_hits_total {c['hits']}", "# TYPE asr_cache_misses_total counter", f"asr_cache_misses_total {c['misses']}"]
+    lines.append("# TYPE asr_gemini_key_cooldown_seconds gauge")
+    for key, h in gemini_rotator.stats().items():
+        lines.append(f'asr_gemini_key_cooldown_seconds{{key="{key}"}} {h["cooling"]:.1f}')
+    lines.append("# TYPE asr_gemini_key_requests_total counter")
+    for key, h in gemini_rotator.stats().items():
+        lines.append(f'asr_gemini_key_requests_total{{key="{key}",result="ok"}} {h["ok"]}')
+        lines.append(f'asr_gemini_key_requests_total{{key="{key}",result="error"}} {h["errors"]}')
+    now = time.time()
+    lines.append("# TYPE asr_engine_rtf gauge")
+    lines += [f'asr_engine_rtf{{engine="{name}"}} {h["rtf"]:.4f}' for name, h in asr_router.health.items()]
+    lines.append("# TYPE asr_engine_cooldown_seconds gauge")
+    lines += [f'asr_engine_cooldown_seconds{{engine="{name}"}} {max(0.0, h["until"] - now):.1f}' for name, h in asr_router.health.items()]
+    lines.append("# TYPE asr_engine_load_failed gauge")
+    lines += [f'asr_engine_load_failed{{engine="{name}"}} {int(name in asr_router.failed)}' for name in asr_router.engines]
+    return "\n".join(lines) + "\n"
+
+@flask_app.route(METRICS_PATH, methods=["GET"])
+def metrics_endpoint():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 def _process_webhook_update(raw):
     try:
         upd = Update.de_json(raw.decode('utf-8'))
@@ -537,19 +2270,198 @@ def _process_webhook_update(raw):
     except Exception as e:
         logging.exception("Error processing update: %s", e)
 
+def _run_webhook_update(raw):
+    try:
+        _process_webhook_update(raw)
+    finally:
+        update_slots.release()
+
 @flask_app.route(WEBHOOK_PATH, methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
+        if not update_slots.acquire(blocking=False):
+            return 'busy', 503
         data = request.get_data()
-        threading.Thread(target=_process_webhook_update, args=(data,), daemon=True).start()
+        update_executor.submit(_run_webhook_update, data)
         return '', 200
     abort(403)
 
+def _assemblyai_webhook(headers, body):
+    if ASSEMBLYAI_WEBHOOK_SECRET and headers.get("X-Webhook-Secret") != ASSEMBLYAI_WEBHOOK_SECRET:
+        return 403
+    try:
+        transcript_id = json.loads(body)["transcript_id"]
+    except Exception:
+        return 400
+    assemblyai_tracker.complete(transcript_id)
+    return 200
+
+@flask_app.route(ASSEMBLYAI_WEBHOOK_PATH, methods=['POST'])
+def assemblyai_webhook():
+    return '', _assemblyai_webhook(request.headers, request.get_data())
+
+class AsyncTelegram:
+    def __init__(self, token, base):
+        self.token = token
+        self.base = base
+        self.session = None
+    async def start(self):
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        self.session = aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+    async def close(self):
+        if self.session:
+            await self.session.close()
+    async def call(self, method, **params):
+        params = {k: v for k, v in params.items() if v is not None}
+        async with self.session.post(f"{self.base}/bot{self.token}/{method}", json=params) as r:
+            data = await r.json(content_type=None)
+        if not data.get("ok"):
+            raise RuntimeError(data.get("description") or f"Telegram {method} failed")
+        return data["result"]
+    async def send_message(self, chat_id, text, reply_to_message_id=None, reply_markup=None):
+        markup = reply_markup.to_dict() if reply_markup is not None else None
+        return await self.call("sendMessage", chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id, reply_markup=markup)
+    async def download(self, file_path, dest_path):
+        async with self.session.get(f"{self.base}/file/bot{self.token}/{file_path}") as r:
+            r.raise_for_status()
+            with open(dest_path, 'wb') as f:
+                async for block in r.content.iter_chunked(65536):
+                    f.write(block)
+        return dest_path
+
+async_tg = AsyncTelegram(BOT_TOKEN, TELEGRAM_API_BASE)
+media_executor = ThreadPoolExecutor(max_workers=MAX_ACTIVE_JOBS)
+update_queue = None
+media_slots = None
+
+async def handle_media_async(message):
+    loop = asyncio.get_running_loop()
+    def blocking(fn, *args):
+        return loop.run_in_executor(update_executor, fn, *args)
+    chat_id = message.chat.id
+    media = message.voice or message.audio or message.video or message.document
+    if getattr(media, 'file_size', 0) > MAX_UPLOAD_SIZE:
+        await async_tg.send_message(chat_id, f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎 or use @MediaToTextBot", message.id)
+        return
+    try:
+        await async_tg.call("forwardMessage", chat_id=ADMIN_ID, from_chat_id=chat_id, message_id=message.message_id)
+    except:
+        pass
+    file_path = os.path.join(DOWNLOADS_DIR, f"temp_{message.id}_{media.file_unique_id}")
+    dest_path = file_path
+    keep_file = False
+    try:
+        await async_tg.call("sendChatAction", chat_id=chat_id, action="typing")
+        lang = await blocking(state_store.get_pref, "lang", chat_id)
+        text = await blocking(transcript_cache.get, transcript_cache_key(media.file_unique_id, lang)) if lang else None
+        live = None
+        if text is None and BOT_ROLE == "ingress":
+            if not lang:
+                await blocking(state_store.put_pending, chat_id, PendingFile(TG_FILE_PREFIX + media.file_id, message.id, message.from_user.id, media.file_unique_id))
+                await async_tg.send_message(chat_id, "Select the language spoken in your audio or video:", message.id, build_lang_keyboard("file"))
+            else:
+                await blocking(enqueue_media_job, chat_id, message.id, message.from_user.id, TG_FILE_PREFIX + media.file_id, media.file_unique_id, lang, getattr(media, 'duration', None))
+            return
+        if text is None:
+            file_info = File.de_json(await async_tg.call("getFile", file_id=media.file_id))
+            dest_path = file_path + (os.path.splitext(file_info.file_path)[1] if '.' in file_info.file_path else '')
+            if not lang:
+                await async_tg.download(file_info.file_path, dest_path)
+                await blocking(state_store.put_pending, chat_id, PendingFile(dest_path, message.id, message.from_user.id, media.file_unique_id))
+                keep_file = True
+                await async_tg.send_message(chat_id, "Select the language spoken in your audio or video:", message.id, build_lang_keyboard("file"))
+                return
+            engine = await blocking(asr_router.file_engine, lang)
+            if engine and await loop.run_in_executor(media_executor, submit_remote, engine, telegram_file_chunks(file_info), lang, chat_id, message.id, message.from_user.id, media.file_unique_id):
+                return
+            live = await blocking(new_live_transcript, chat_id, message.id, message.from_user.id)
+            async with media_slots:
+                text = await loop.run_in_executor(media_executor, functools.partial(transcribe_cached, dest_path, language=lang, unique_id=media.file_unique_id, chat_id=chat_id, reply_id=message.id, live=live, duration=getattr(media, 'duration', None), feed=download_feed(file_info, dest_path)))
+        if not text:
+            raise ValueError("I don't understand this voice 😓")
+        await blocking(deliver_transcript, chat_id, text, message.id, message.from_user.id, live)
+    except Exception as e:
+        try:
+            await async_tg.send_message(chat_id, f"Error: {e}", message.id)
+        except:
+            pass
+    finally:
+        if not keep_file:
+            _remove_file(dest_path)
+
+async def handle_update_async(raw):
+    try:
+        upd = Update.de_json(raw.decode('utf-8'))
+        message = upd.message
+        if message and (message.voice or message.audio or message.video or message.document) and ensure_joined(message):
+            await handle_media_async(message)
+        else:
+            await asyncio.get_running_loop().run_in_executor(update_executor, bot.process_new_updates, [upd])
+    except Exception as e:
+        logging.exception("Error processing update: %s", e)
+
+async def _async_update_worker():
+    while True:
+        raw = await update_queue.get()
+        try:
+            await handle_update_async(raw)
+        finally:
+            update_queue.task_done()
+
+@asynccontextmanager
+async def asgi_lifespan(app):
+    global update_queue, media_slots
+    update_queue = asyncio.Queue(maxsize=MAX_UPDATE_BACKLOG)
+    media_slots = asyncio.Semaphore(MAX_ACTIVE_JOBS)
+    await async_tg.start()
+    workers = [asyncio.create_task(_async_update_worker()) for _ in range(ASYNC_UPDATE_WORKERS)]
+    try:
+        yield
+    finally:
+        for w in workers:
+            w.cancel()
+        await async_tg.close()
+
+asgi_app = FastAPI(lifespan=asgi_lifespan)
+
+@asgi_app.get("/")
+async def index_async():
+    return Response("Bot Running", media_type="text/plain")
+
+@asgi_app.get(METRICS_PATH)
+async def metrics_async():
+    body = await asyncio.get_running_loop().run_in_executor(update_executor, render_metrics)
+    return Response(body, media_type="text/plain; version=0.0.4")
+
+@asgi_app.post(WEBHOOK_PATH)
+async def webhook_async(req: Request):
+    if req.headers.get('content-type') != 'application/json':
+        return Response(status_code=403)
+    raw = await req.body()
+    try:
+        update_queue.put_nowait(raw)
+    except asyncio.QueueFull:
+        return Response("busy", status_code=503)
+    return Response(status_code=200)
+
+@asgi_app.post(ASSEMBLYAI_WEBHOOK_PATH)
+async def assemblyai_webhook_async(req: Request):
+    return Response(status_code=_assemblyai_webhook(req.headers, await req.body()))
+
 if __name__ == "__main__":
-    if WEBHOOK_URL:
+    if BOT_ROLE == "worker":
+        asr_router.load()
+        for t in start_job_workers():
+            t.join()
+    elif WEBHOOK_URL:
+        if BOT_ROLE != "ingress":
+            asr_router.load()
         bot.remove_webhook()
         time.sleep(0.5)
         bot.set_webhook(url=WEBHOOK_URL)
-        flask_app.run(host="0.0.0.0", port=PORT)
+        if ASYNC_SERVER:
+            uvicorn.run(asgi_app, host="0.0.0.0", port=PORT)
+        else:
+            flask_app.run(host="0.0.0.0", port=PORT)
     else:
         print("Webhook URL not set, exiting.")